@@ -0,0 +1,6 @@
+# app/__main__.py
+from app.cli import main
+
+# При start method spawn процессы пула заново импортируют __main__ и не должны запускать команду
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# app/bench/crawl.py
+"""Бенчмарк полного прогона main_loop против локального синтетического реестра.
+
+Сервер (app/bench/server.py) поднимается в отдельном процессе, чтобы не делить с парсером
+event loop и не попадать в его пиковую память; хранилища — в памяти (app/bench/storage.py).
+
+    python -m app bench --codes 200 --names 5 --files 1 --latency 0.05 --workers 10
+    python -m app bench --codes 2000 --per-page 50 --names 1
+    python -m app bench --error-rate 0.05 --json >> bench.jsonl
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import socket
+import sys
+import time
+import aiohttp
+from loguru import logger
+from app.bench.server import add_arguments, options_from_args, serve
+from app.bench.storage import MemoryMongoStorage, MemoryPostgresStorage
+from app.config import (
+    CodesPageTags, DiscoveryConfig, HttpCacheConfig, LimitsConfig, MetricsConfig, NamesPageTags, Settings, TagsConfig,
+    add_config_argument, get_settings
+)
+from app.main import main_loop
+from app.metrics import metrics
+
+LINKS_SELECTOR = "a[href*='/product/']"
+FILE_LINK_SELECTOR = "a[href$='.pdf'], img[src]"
+STAGES = ('fetch', 'parse', 'pg_write', 'pg_claim', 'gridfs_upload')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(url: str, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Fake registry at {url} did not start")
+            await asyncio.sleep(0.1)
+
+
+def bench_settings(args, base_url: str) -> Settings:
+    settings = get_settings(args.config)
+    site = settings.site.model_copy(update={
+        'base_url': base_url, 'max_workers': args.workers, 'parse_workers': args.parse_workers,
+        'requests_per_second': args.rps, 'max_requests_per_second': None, 'retry_backoff': 0.05,
+    })
+    # Разметка синтетического реестра известна заранее — селекторы под неё, а не из конфига
+    tags = TagsConfig(
+        codes_page=CodesPageTags(links_selector=LINKS_SELECTOR, pagination_selector='.pagination a'),
+        names_page=NamesPageTags(links_selector=LINKS_SELECTOR),
+        file_link_selector=FILE_LINK_SELECTOR,
+    )
+    return settings.model_copy(update={
+        'site': site, 'tags': tags, 'discovery': DiscoveryConfig(),
+        'http_cache': HttpCacheConfig(enabled=False), 'limits': LimitsConfig(),
+        'metrics': MetricsConfig(port=None, summary_interval=0),
+    })
+
+
+async def run_crawl(settings: Settings, args) -> dict:
+    postgres_config = settings.database.postgres
+    queue_config = settings.queue
+    # Параметры очереди — как у main_loop, чтобы бенчмарк проверял настроенные аренды
+    postgres = MemoryPostgresStorage(postgres_config.batch_size, postgres_config.flush_interval,
+                                     queue_config.worker_id or 'bench', queue_config.lease_seconds,
+                                     queue_config.retry_delay)
+    mongo = MemoryMongoStorage()
+    started = time.perf_counter()
+    await main_loop(settings, postgres=postgres, mongo=mongo)
+    elapsed = time.perf_counter() - started
+
+    pages = metrics.counter('pages')
+    result = {
+        'codes': args.codes, 'names': args.names, 'files': args.files, 'workers': args.workers,
+        'latency': args.latency, 'error_rate': args.error_rate,
+        'seconds': round(elapsed, 3),
+        'pages': int(pages),
+        'expected_pages': options_from_args(args).listing_pages + args.codes + args.codes * args.names,
+        'pages_per_second': round(pages / elapsed, 2) if elapsed else 0.0,
+        'rawdata_rows': len(postgres.rawdata),
+        'files_stored': mongo.stats['stored'],
+        'mb': round((metrics.counter('bytes', kind='page') + metrics.counter('bytes', kind='file')) / 1024 / 1024,
+                    2),
+        'retries': int(sum(v for (n, _), v in metrics.counters.items() if n == 'retries')),
+        'errors': int(sum(v for (n, _), v in metrics.counters.items() if n == 'errors')),
+        'db_round_trips': int(metrics.counter('db_statements')),
+        # ru_maxrss в Linux — в килобайтах
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for stage in STAGES:
+        histogram = metrics.histogram('stage_seconds', stage=stage)
+        if histogram:
+            result[f'{stage}_p50_ms'] = round(histogram.quantile(0.5) * 1000, 1)
+            result[f'{stage}_p99_ms'] = round(histogram.quantile(0.99) * 1000, 1)
+    return result
+
+
+def print_report(result: dict):
+    print(f"pages: {result['pages']}/{result['expected_pages']} in {result['seconds']}s "
+          f"({result['pages_per_second']} pages/s), {result['mb']} MB")
+    print(f"rawdata rows: {result['rawdata_rows']}, files stored: {result['files_stored']}, "
+          f"retries: {result['retries']}, errors: {result['errors']}")
+    print(f"DB round trips: {result['db_round_trips']}, peak RSS: {result['peak_rss_mb']} MB")
+    for stage in STAGES:
+        if f'{stage}_p50_ms' in result:
+            print(f"{stage:>14}: p50 {result[f'{stage}_p50_ms']} ms, p99 {result[f'{stage}_p99_ms']} ms")
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Benchmark a full crawl against a local synthetic registry")
+    add_arguments(parser)
+    add_config_argument(parser)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--rps', type=float, default=1000, help="request rate limit")
+    parser.add_argument('--port', type=int, default=0, help="fake registry port, 0 — any free one")
+    parser.add_argument('--json', action='store_true', help="print the result as one JSON line")
+    parser.add_argument('--verbose', action='store_true', help="keep parser logs")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level='WARNING')
+
+    port = args.port or free_port()
+    base_url = f'http://127.0.0.1:{port}/'
+    server = multiprocessing.Process(target=serve, args=(options_from_args(args), '127.0.0.1', port), daemon=True)
+    server.start()
+    try:
+        asyncio.run(wait_for_server(base_url))
+        result = asyncio.run(run_crawl(bench_settings(args, base_url), args))
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# app/bench/parsing.py
+"""Микробенчмарк разбора страниц товара на сохранённых телах rawdata (сжатых или нет).
+
+    python -m app bench parsing --limit 200 --repeat 3
+"""
+import argparse
+import asyncio
+import time
+from bs4 import BeautifulSoup
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app.config import PostgresConfig, add_config_argument, get_settings
+from app.models.postgres import Rawdata
+from app.parsers.document import Document
+from app.storage.codec import set_dictionary_dir
+
+LINKS_SELECTOR = "a[href*='/product/']"
+FILE_LINK_SELECTOR = "a[href$='.pdf'], a[href$='.zip'], a[href$='.doc'], a[href$='.docx'], img[src]"
+
+
+async def load_samples(postgres: PostgresConfig, limit: int) -> list:
+    engine = create_async_engine(postgres.url)
+    try:
+        async with AsyncSession(engine) as session:
+            result = await session.execute(
+                select(Rawdata)
+                .where(or_(Rawdata.body_html.isnot(None), Rawdata.body_zip.isnot(None)))
+                .order_by(Rawdata.id)
+                .limit(limit)
+            )
+            return [f"<html>{row.body}</html>" for row in result.scalars()]
+    finally:
+        await engine.dispose()
+
+
+def parse_with_soup(html: str, links_selector: str, file_selector: str):
+    # Так страница разбиралась раньше: отдельное дерево на каждый экстрактор
+    links = [(a.get('href'), a.get_text(strip=True)) for a in BeautifulSoup(html, 'lxml').select(links_selector)]
+    body = str(BeautifulSoup(html, 'lxml').find('body'))
+    files = [el.get('href') or el.get('src') for el in BeautifulSoup(html, 'lxml').select(file_selector)]
+    return links, body, files
+
+
+def parse_with_document(html: str, links_selector: str, file_selector: str):
+    doc = Document(html)
+    return doc.links(links_selector), doc.body_html(), doc.urls(file_selector)
+
+
+def measure(func, samples: list, repeat: int, *args) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for html in samples:
+            func(html, *args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Benchmark page parsing on stored rawdata samples")
+    add_config_argument(parser)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--links-selector', default=LINKS_SELECTOR)
+    parser.add_argument('--file-selector', default=FILE_LINK_SELECTOR)
+    args = parser.parse_args(argv)
+
+    settings = get_settings(args.config)
+    set_dictionary_dir(settings.rawdata.dictionary_dir)
+    samples = asyncio.run(load_samples(settings.database.postgres, args.limit))
+    if not samples:
+        print("No rawdata samples found")
+        return
+
+    selectors = (args.links_selector, args.file_selector)
+    soup_time = measure(parse_with_soup, samples, args.repeat, *selectors)
+    doc_time = measure(parse_with_document, samples, args.repeat, *selectors)
+    print(f"samples: {len(samples)}, total: {sum(len(s) for s in samples) / 1024:.0f} KB")
+    print(f"BeautifulSoup x3: {soup_time * 1000 / len(samples):.2f} ms/page")
+    print(f"Document (lxml):  {doc_time * 1000 / len(samples):.2f} ms/page")
+    print(f"speedup: {soup_time / doc_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# app/bench/server.py
+"""Синтетический реестр на aiohttp.web для офлайн-бенчмарков.
+
+Структура повторяет сайт: индекс со ссылками на коды (с пагинацией при --per-page), страница кода со ссылками на товары,
+страница товара с общими для сайта блоками и ссылками на файлы. Задержка и доля ответов 503
+задаются параметрами; содержимое детерминировано по seed, поэтому прогоны повторяемы.
+
+    python -m app bench server --codes 100 --names 5 --files 2 --port 8765
+"""
+import argparse
+import asyncio
+import random
+from typing import NamedTuple
+from aiohttp import web
+
+CHROME = (
+    '<header><div class="logo">Реестр</div><form class="search"><input name="q"></form></header>'
+    '<nav>' + ''.join(f'<a href="/section/{i}/">Раздел {i}</a>' for i in range(30)) + '</nav>'
+)
+FOOTER = '<footer>' + '<p>Справочная информация, контакты и правила использования.</p>' * 10 + '</footer>'
+
+
+class RegistryOptions(NamedTuple):
+    codes: int = 50  # кодов в каталоге
+    names: int = 5  # товаров на странице кода
+    files: int = 1  # файлов на странице товара
+    file_size: int = 64 * 1024  # байт в файле
+    duplicate_files: float = 0.0  # доля файлов с одинаковым содержимым (проверка дедупликации)
+    latency: float = 0.02  # средняя задержка ответа, секунд
+    error_rate: float = 0.0  # доля ответов 503
+    seed: int = 1
+    per_page: int = 0  # кодов на странице индекса, 0 — все на одной странице
+
+    @property
+    def listing_pages(self) -> int:
+        return -(-self.codes // self.per_page) if self.per_page else 1
+
+
+class FakeRegistry:
+    def __init__(self, options: RegistryOptions):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.blob = random.Random(options.seed).randbytes(options.file_size)
+        self.requests = 0
+
+    def page(self, title: str, body: str) -> web.Response:
+        html = (f'<html><head><meta charset="utf-8"><title>{title}</title></head>'
+                f'<body>{CHROME}<main><h1>{title}</h1>{body}</main>{FOOTER}</body></html>')
+        return web.Response(text=html, content_type='text/html', charset='utf-8')
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        options = self.options
+        if options.latency:
+            await asyncio.sleep(self.random.uniform(0.5, 1.5) * options.latency)
+        if options.error_rate and self.random.random() < options.error_rate:
+            return web.Response(status=503, text='Service Unavailable')
+        return await handler(request)
+
+    async def index(self, request):
+        options = self.options
+        number = int(request.query.get('page', 1))
+        last = options.listing_pages
+        if not 1 <= number <= last:
+            raise web.HTTPNotFound()
+        per_page = options.per_page or options.codes
+        first = (number - 1) * per_page + 1
+        links = ''.join(f'<li><a href="/product/{code}/">Код {code}</a></li>'
+                        for code in range(first, min(first + per_page, options.codes + 1)))
+        # Как на настоящих сайтах: соседние страницы и последняя, а не все подряд
+        pages = sorted({n for n in (1, number - 1, number + 1, last) if 1 <= n <= last} - {number})
+        pagination = ''.join(f'<a href="/?page={n}">{n}</a>' for n in pages)
+        return self.page('Федеральный реестр', f'<ul>{links}</ul><div class="pagination">{pagination}</div>')
+
+    async def code(self, request):
+        code = int(request.match_info['code'])
+        if not 1 <= code <= self.options.codes:
+            raise web.HTTPNotFound()
+        links = ''.join(f'<li><a href="/product/{code}/{i}/">Товар {code}-{i}</a></li>'
+                        for i in range(1, self.options.names + 1))
+        return self.page(f'Код {code}', f'<ul>{links}</ul>')
+
+    async def product(self, request):
+        code, item = request.match_info['code'], request.match_info['item']
+        files = ''.join(f'<li><a href="/files/{code}-{item}-{k}.pdf">Документ {k}</a></li>'
+                        for k in range(1, self.options.files + 1))
+        details = ''.join(f'<tr><th>Поле {k}</th><td>Значение {code}-{item}-{k}</td></tr>' for k in range(20))
+        body = f'<table>{details}</table><ul>{files}</ul><img src="/static/{code}-{item}.png">'
+        return self.page(f'Товар {code}-{item}', body)
+
+    async def file(self, request):
+        name = request.match_info['name']
+        # Уникальный файл отличается от общего блоба префиксом с именем
+        duplicate = random.Random(name).random() < self.options.duplicate_files
+        prefix = b'' if duplicate else name.encode()
+        return web.Response(body=prefix + self.blob[len(prefix):], content_type='application/pdf')
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/', self.index)
+        app.router.add_get('/product/{code}/', self.code)
+        app.router.add_get('/product/{code}/{item}/', self.product)
+        app.router.add_get('/files/{name}', self.file)
+        return app
+
+
+def serve(options: RegistryOptions, host: str = '127.0.0.1', port: int = 8765):
+    web.run_app(FakeRegistry(options).app(), host=host, port=port, print=None, access_log=None)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = RegistryOptions()
+    parser.add_argument('--codes', type=int, default=defaults.codes)
+    parser.add_argument('--names', type=int, default=defaults.names, help="products per code page")
+    parser.add_argument('--files', type=int, default=defaults.files, help="attachments per product page")
+    parser.add_argument('--file-size', type=int, default=defaults.file_size, help="attachment size in bytes")
+    parser.add_argument('--duplicate-files', type=float, default=defaults.duplicate_files,
+                        help="share of attachments with identical content")
+    parser.add_argument('--latency', type=float, default=defaults.latency, help="mean response delay, seconds")
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate, help="share of 503 responses")
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--per-page', type=int, default=defaults.per_page, help="codes per index page, 0 — all")
+
+
+def options_from_args(args) -> RegistryOptions:
+    return RegistryOptions(args.codes, args.names, args.files, args.file_size, args.duplicate_files,
+                           args.latency, args.error_rate, args.seed, args.per_page)
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Serve a synthetic registry for offline benchmarks")
+    add_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+    serve(options_from_args(args), args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
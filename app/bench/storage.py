@@ -0,0 +1,246 @@
+# app/bench/storage.py
+"""Хранилища в памяти с интерфейсом PostgresStorage/MongoStorage для бенчмарков.
+
+Вся логика остаётся от настоящих классов: буферы, пачки, аренды и их продление в PostgresStorage,
+дедупликация и восстановление загрузок в MongoStorage. Подменяются только самые нижние
+обращения к БД — отдельные SQL-операторы PostgresStorage, коллекции и GridFS для MongoStorage.
+Каждый SQL-оператор увеличивает metrics db_statements так же, как реальный запрос к серверу,
+поэтому число обращений к БД сравнимо между прогонами и с боевым режимом.
+Тела страниц и файлов не хранятся — только размеры и хэши, чтобы не искажать пиковую память.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import count
+from typing import List, Optional, Tuple
+from pymongo.errors import DuplicateKeyError
+from app.metrics import metrics
+from app.models.postgres import Code, Name
+from app.storage.mongo import MongoStorage
+from app.storage.postgres import CLAIMABLE, PENDING_STATUSES, PostgresStorage
+
+
+class MemorySession:
+    """Вместо AsyncSession: операторы выполняют методы MemoryPostgresStorage, транзакций нет."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def begin(self):
+        return self
+
+
+class MemoryPostgresStorage(PostgresStorage):
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0, worker_id: str = 'bench',
+                 lease_seconds: int = 600, retry_delay: int = 900):
+        super().__init__(MemorySession, batch_size, flush_interval, worker_id, lease_seconds, retry_delay)
+        self.tables = {Code: {}, Name: {}}  # id → строка
+        self.keys = {Code: set(), Name: set()}  # уникальные code/url и name/url
+        self.rawdata = {}  # product_name → размер тела в байтах
+        self.images = {}
+        self.checkpoints = {}  # key → время отметки
+        self._ids = {Code: count(1), Name: count(1)}
+
+    async def _insert_rawdata(self, session, rows: List[dict]):
+        metrics.inc('db_statements')
+        for row in rows:
+            body = row['body_zip'] if row['body_zip'] is not None else (row['body_html'] or '').encode('utf-8')
+            self.rawdata.setdefault(row['product_name'], len(body))
+
+    async def _upsert_images(self, session, rows: List[dict]):
+        metrics.inc('db_statements')
+        for row in rows:
+            key = (row['product_name'], row['file_url'])
+            self.images[key] = row['file_id'] or self.images.get(key)
+
+    async def _set_status(self, session, model, ids: List[int], status: str, failed: bool, release: bool,
+                          retry_after: Optional[timedelta]):
+        metrics.inc('db_statements')
+        now = datetime.utcnow()
+        for row_id in ids:
+            row = self.tables[model][row_id]
+            if row.locked_by != self.worker_id:
+                continue
+            row.status = status
+            if failed:
+                row.attempts += 1
+            if release:
+                row.locked_by = None
+                row.locked_until = now + retry_after if retry_after else None
+
+    def _insert(self, model, rows: List[dict], unique: Tuple[str, ...]) -> list:
+        metrics.inc('db_statements')
+        inserted = []
+        for values in rows:
+            keys = [(column, values[column]) for column in unique]
+            if any(key in self.keys[model] for key in keys):
+                continue
+            self.keys[model].update(keys)
+            row = model(id=next(self._ids[model]), status='pending', attempts=0, **values)
+            self.tables[model][row.id] = row
+            inserted.append(row)
+        return inserted
+
+    async def _insert_codes(self, session, rows: List[dict]) -> int:
+        return len(self._insert(Code, rows, ('code', 'url')))
+
+    async def _set_checkpoint(self, session, key: str, value: str):
+        metrics.inc('db_statements')
+        self.checkpoints[key] = datetime.utcnow()
+
+    async def checkpoint_age(self, key: str) -> Optional[float]:
+        metrics.inc('db_statements')
+        updated_at = self.checkpoints.get(key)
+        return (datetime.utcnow() - updated_at).total_seconds() if updated_at else None
+
+    async def has_pending_codes(self) -> bool:
+        metrics.inc('db_statements')
+        return any(row.status in PENDING_STATUSES for row in self.tables[Code].values())
+
+    async def _insert_leased_names(self, session, rows: List[dict]) -> List[Name]:
+        locked_until = datetime.utcnow() + self.lease
+        rows = [{**row, 'locked_by': self.worker_id, 'locked_until': locked_until} for row in rows]
+        return self._insert(Name, rows, ('name', 'url'))
+
+    async def _finish_code(self, session, code_id: int) -> bool:
+        metrics.inc('db_statements')
+        row = self.tables[Code][code_id]
+        if row.locked_by != self.worker_id:
+            return False
+        row.status, row.locked_by, row.locked_until = 'fetched', None, None
+        return True
+
+    async def pending_files(self, product_name: str) -> List[str]:
+        metrics.inc('db_statements')
+        return [url for (name, url), file_id in self.images.items() if name == product_name and file_id is None]
+
+    async def _lease_rows(self, session, model, limit: int) -> list:
+        metrics.inc('db_statements')
+        now = datetime.utcnow()
+        claimed = []
+        for row in self.tables[model].values():
+            if len(claimed) >= limit:
+                break
+            if row.status in CLAIMABLE[model] and (row.locked_until is None or row.locked_until < now):
+                row.locked_by, row.locked_until = self.worker_id, now + self.lease
+                claimed.append(row)
+        return claimed
+
+    async def _extend_leases(self, session, model, ids: List[int]) -> List[int]:
+        metrics.inc('db_statements')
+        locked_until = datetime.utcnow() + self.lease
+        renewed = []
+        for row_id in ids:
+            row = self.tables[model][row_id]
+            if row.locked_by == self.worker_id:
+                row.locked_until = locked_until
+                renewed.append(row_id)
+        return renewed
+
+    async def _release_rows(self, session, model):
+        metrics.inc('db_statements')
+        for row in self.tables[model].values():
+            if row.locked_by == self.worker_id and row.status in CLAIMABLE[model]:
+                row.locked_by, row.locked_until = None, None
+
+    async def has_rawdata(self, product_name: str) -> bool:
+        metrics.inc('db_statements')
+        return product_name in self.rawdata
+
+    async def estimate_rawdata_count(self) -> int:
+        metrics.inc('db_statements')
+        return len(self.rawdata)
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif '$lt' in condition and not (value is not None and value < condition['$lt']):
+            return False
+        elif '$in' in condition and value not in condition['$in']:
+            return False
+    return True
+
+
+class MemoryCollection:
+    """Коллекция MongoDB в памяти — только операции, которые использует MongoStorage."""
+
+    def __init__(self):
+        self.docs = {}  # _id → документ
+
+    def _find(self, query: dict) -> list:
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return [doc] if doc is not None and _matches(doc, query) else []
+        return [doc for doc in self.docs.values() if _matches(doc, query)]
+
+    async def find_one(self, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        found = self._find(query)
+        return dict(found[0]) if found else None
+
+    async def find(self, query: dict, projection: Optional[dict] = None):
+        for doc in self._find(query):
+            yield dict(doc)
+
+    async def insert_one(self, doc: dict):
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError(f"duplicate key {doc['_id']!r}")
+        self.docs[doc['_id']] = dict(doc)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        doc = self.docs.get(query['_id'])
+        if doc is None:
+            if not upsert:
+                return
+            doc = self.docs[query['_id']] = {'_id': query['_id']}
+        doc.update(update['$set'])
+
+    async def delete_many(self, query: dict):
+        for doc in self._find(query):
+            del self.docs[doc['_id']]
+
+
+class MemoryGridIn:
+    """Загрузка в GridFS: считается только размер, куски не хранятся."""
+
+    def __init__(self, files: MemoryCollection, file_id, filename: str, metadata: dict):
+        self.files = files
+        self._id = file_id
+        self.doc = {'_id': file_id, 'filename': filename, 'metadata': metadata, 'length': 0}
+
+    async def write(self, chunk: bytes):
+        self.doc['length'] += len(chunk)
+
+    async def set(self, name: str, value):
+        self.doc[name] = value
+
+    async def close(self):
+        await self.files.insert_one(self.doc)
+
+    async def abort(self):
+        pass
+
+
+class MemoryBucket:
+    def __init__(self, db, bucket_name: str):
+        self.files = db[f'{bucket_name}.files']
+
+    def open_upload_stream_with_id(self, file_id, filename: str, metadata: dict) -> MemoryGridIn:
+        return MemoryGridIn(self.files, file_id, filename, metadata)
+
+    async def delete(self, file_id):
+        self.files.docs.pop(file_id, None)
+
+
+class MemoryMongoStorage(MongoStorage):
+    def __init__(self):
+        # Клиент и база — словари: client[db][collection] → MemoryCollection
+        super().__init__(defaultdict(lambda: defaultdict(MemoryCollection)), 'bench', 'files')
+
+    def _bucket(self, bucket_name: str) -> MemoryBucket:
+        return MemoryBucket(self.db, bucket_name)
@@ -0,0 +1,50 @@
+# app/cli.py
+"""Единая точка входа: python -m app <команда> [аргументы команды].
+
+Модуль команды импортируется только при её запуске, поэтому headless-воркер не грузит
+tkinter, а export — aiohttp и пул парсинга. Аргументы после имени команды разбирает
+сама команда: python -m app export --help.
+"""
+import argparse
+import importlib
+import sys
+
+# команда → (модуль с main(argv, prog), описание)
+COMMANDS = {
+    'crawl': ('app.main', "run the crawler headless (servers, containers)"),
+    'gui': ('app.gui', "run the crawler with a monitoring window"),
+    'discover': ('app.parsers.discovery', "crawl the catalog and queue product codes only"),
+    'export': ('app.export', "export crawled data to partitioned JSONL or Parquet"),
+    'extract': ('app.extract', "extract structured product fields from stored rawdata"),
+    'compact': ('app.storage.compact', "compress stored rawdata bodies in place"),
+    'bench': ('app.bench.crawl', "benchmark a full crawl against a local synthetic registry"),
+}
+
+# Вспомогательные бенчмарки: python -m app bench parsing|server
+BENCH_COMMANDS = {
+    'parsing': 'app.bench.parsing',
+    'server': 'app.bench.server',
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        prog='python -m app', description="Reestr parser",
+        epilog="Run 'python -m app <command> --help' for command options.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest='command', metavar='<command>', required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        # Аргументы команды не описываются здесь, чтобы не импортировать её модуль ради --help
+        commands.add_parser(name, help=help_text, add_help=False)
+    command = parser.parse_args(argv[:1]).command
+    module = COMMANDS[command][0]
+    rest = argv[1:]
+    if command == 'bench' and rest and rest[0] in BENCH_COMMANDS:
+        command, module, rest = f'bench {rest[0]}', BENCH_COMMANDS[rest[0]], rest[1:]
+    importlib.import_module(module).main(rest, prog=f'python -m app {command}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,13 @@
 # app/config.py
-from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List
+import os
+from functools import lru_cache
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict, YamlConfigSettingsSource
+from typing import Dict, List, Optional
+
+DEFAULT_CONFIG = 'config.yaml'
+# Путь к конфигу, если он не передан явно, — удобно в контейнерах
+CONFIG_ENV = 'REESTR_CONFIG'
 
 
 class SiteConfig(BaseSettings):
@@ -8,13 +15,57 @@ class SiteConfig(BaseSettings):
     delay_between_requests: float
     max_workers: int
     user_agent: str
+    requests_per_second: Optional[float] = None  # по умолчанию 1 / delay_between_requests
+    max_requests_per_second: Optional[float] = None  # задан — скорость подстраивается под сервер до этого предела
+    min_requests_per_second: float = 0.2  # ниже адаптивный лимитер не опускается
+    max_retries: int = 3  # повторов одного запроса при таймаутах, 429 и 5xx
+    retry_backoff: float = 1.0  # база экспоненциальной задержки между повторами, секунд
+    retry_backoff_max: float = 60
+    max_page_attempts: int = 5  # неудачных прогонов, после которых страница получает статус error
+    queue_size: int = 100  # размер очереди между стадиями и пачки чтения pending-строк
+    parse_workers: int = 0  # процессы для разбора HTML, 0 — разбор в основном потоке
+    max_file_size_mb: int = 50  # файлы больше лимита не скачиваются
+    download_chunk_size: int = 256 * 1024  # байт за одну запись в GridFS
+    connection_limit: int = 20  # соединений в общем пуле aiohttp
+    connection_limit_per_host: int = 10
+    dns_cache_ttl: int = 300  # секунд
+    keepalive_timeout: float = 30  # секунд простоя до закрытия соединения
+    page_timeout: float = 30  # секунд на страницу; для файлов — на чтение очередного куска
+    file_timeout: float = 600  # секунд на скачивание файла целиком
+
+
+class HttpCacheConfig(BaseSettings):
+    enabled: bool = False
+    directory: str = 'cache/http'
+    max_size_mb: int = 512
+
+
+class CodesPageTags(BaseSettings):
+    links_selector: str  # ссылки на страницы кодов в индексе и списках каталога
+    category_selector: Optional[str] = None  # ссылки на разделы каталога со своими списками кодов
+    pagination_selector: Optional[str] = None  # ссылки на другие страницы того же списка
+    page_pattern: str = r'[?&]page=(\d+)'  # номер страницы в URL пагинации — первая группа
+
+
+class NamesPageTags(BaseSettings):
+    links_selector: str  # ссылки на товары на странице кода
 
 
 class TagsConfig(BaseSettings):
-    links_selector: str
+    codes_page: CodesPageTags
+    names_page: NamesPageTags
     file_link_selector: str
 
 
+class DiscoveryConfig(BaseSettings):
+    enabled: bool = True  # False — коды только из очереди, обход каталога запускается отдельно
+    workers: Optional[int] = None  # одновременных запросов к страницам списка, по умолчанию site.max_workers
+    batch_size: int = 500  # кодов в одной вставке
+    max_pages: Optional[int] = None  # предохранитель от бесконечной пагинации
+    shard_index: int = 0  # этот процесс обходит страницы с номером N, где N % shard_count == shard_index
+    shard_count: int = 1
+
+
 class PostgresConfig(BaseSettings):
     host: str
     port: int
@@ -22,6 +73,14 @@ class PostgresConfig(BaseSettings):
     username: str
     password: str
     echo: bool = False
+    pool_size: int = 10  # постоянных соединений в пуле
+    max_overflow: int = 10  # дополнительных соединений сверх pool_size под нагрузкой
+    pool_timeout: float = 30  # секунд ожидания свободного соединения
+    pool_recycle: int = 1800  # пересоздавать соединения старше N секунд
+    pool_pre_ping: bool = True
+    statement_cache_size: int = 100  # подготовленных выражений на соединение, 0 — выключено (pgbouncer)
+    batch_size: int = 500  # строк в одной пачке INSERT/UPDATE
+    flush_interval: float = 1.0  # максимум секунд между сбросами накопленных строк
 
     @property
     def url(self) -> str:
@@ -54,18 +113,87 @@ class BlacklistConfig(BaseSettings):
     file_extensions: List[str]
 
 
+class RawdataConfig(BaseSettings):
+    compress: bool = False  # хранить body_html сжатым в body_zip
+    method: str = 'zstd'  # zstd или zlib; без пакета zstandard — zlib
+    level: int = 3
+    dictionary_dir: str = 'dicts'  # обученные zstd-словари <dict_id>.zdict
+    dictionary_id: Optional[int] = None  # словарь для новых строк, см. python -m app.storage.compact --train
+    strip_selectors: List[str] = []  # общие для всех страниц блоки (меню, подвал), которые не сохраняются
+
+
+class QueueConfig(BaseSettings):
+    worker_id: Optional[str] = None  # по умолчанию hostname:pid
+    lease_seconds: int = 600  # сколько строка codes/names закреплена за взявшим её воркером
+    retry_delay: int = 900  # через сколько секунд строку в статусе retry можно брать снова
+    # Продолжение прерванного прогона (в очереди остались коды) не обходит каталог заново, если обход
+    # завершился не раньше, чем столько секунд назад; 0 — обходить каждый раз
+    discovery_interval: int = 86400
+
+
+class LimitsConfig(BaseSettings):
+    max_pages: Optional[int] = None
+    max_rawdata: Optional[int] = None  # строк во всей таблице rawdata
+    max_mb: Optional[int] = None  # скачано страниц и файлов, МБ
+    max_seconds: Optional[int] = None
+
+
+class MetricsConfig(BaseSettings):
+    port: Optional[int] = 9108  # /metrics в формате Prometheus, пусто — без HTTP-эндпоинта
+    host: str = '127.0.0.1'
+    summary_interval: float = 60  # секунд между строками сводки в логе, 0 — выключено
+    trace_file: Optional[str] = None  # JSONL со спанами по каждому URL и стадии
+
+
+class ExportConfig(BaseSettings):
+    directory: str = 'export'  # партиции exported_at=<время>/part-NNNNN.<формат> и файл состояния
+    format: str = 'jsonl'  # jsonl или parquet (нужен pyarrow)
+    statuses: List[str] = ['stored']  # какие имена выгружать
+    batch_size: int = 1000  # строк за одну выборку с курсора и в одной записи
+    rows_per_file: int = 100000
+    include_body: bool = True
+    files_directory: Optional[str] = None  # задан — вложения из GridFS копируются сюда по sha256
+    file_workers: int = 8  # одновременных загрузок из GridFS
+    # Сколько секунд до прошлой границы перечитывать: updated_at ставится по часам воркера до коммита,
+    # и такие строки видны не сразу. Должно быть больше самой долгой транзакции плюс расхождение часов
+    overlap_seconds: int = 300
+
+
+class FieldRule(BaseSettings):
+    selector: str  # CSS-селектор; берётся первый подходящий элемент
+    attribute: Optional[str] = None  # по умолчанию — текст элемента
+    regex: Optional[str] = None  # из текста берётся первая группа, а без групп — всё совпадение
+    type: str = 'str'  # str, int, float, date, bool
+    date_format: str = '%d.%m.%Y'
+
+
+class ExtractionConfig(BaseSettings):
+    batch_size: int = 500  # строк rawdata за одну выборку
+    workers: Optional[int] = None  # процессов для разбора: None — по числу ядер, 0 — без пула, как site.parse_workers
+    fields: Dict[str, FieldRule] = {}  # producer, volume, abv, registered_at, valid_until — свои столбцы products
+
+
 class GuiConfig(BaseSettings):
-    refresh_interval: int
+    refresh_interval: float  # секунд между обновлениями окна
+    log_lines: int = 1000  # строк лога в окне, старые удаляются
 
 
 class Settings(BaseSettings):
-    model_config = SettingsConfigDict(yaml_file="config.yaml")
+    model_config = SettingsConfigDict(yaml_file=DEFAULT_CONFIG)
 
     site: SiteConfig
+    http_cache: HttpCacheConfig = Field(default_factory=HttpCacheConfig)
     tags: TagsConfig
+    discovery: DiscoveryConfig = Field(default_factory=DiscoveryConfig)
     database: DatabaseConfig
     logging: LoggingConfig
     blacklist: BlacklistConfig
+    rawdata: RawdataConfig = Field(default_factory=RawdataConfig)
+    queue: QueueConfig = Field(default_factory=QueueConfig)
+    limits: LimitsConfig = Field(default_factory=LimitsConfig)
+    metrics: MetricsConfig = Field(default_factory=MetricsConfig)
+    export: ExportConfig = Field(default_factory=ExportConfig)
+    extraction: ExtractionConfig = Field(default_factory=ExtractionConfig)
     gui: GuiConfig
 
     @classmethod
@@ -77,4 +205,31 @@ class Settings(BaseSettings):
         dotenv_settings,
         file_secret_settings,
     ):
-        return (init_settings, env_settings, file_secret_settings, dotenv_settings)
+        # Порядок — приоритет: аргументы конструктора, окружение, затем YAML-файл из model_config
+        return (init_settings, env_settings, file_secret_settings, dotenv_settings,
+                YamlConfigSettingsSource(settings_cls))
+
+
+def config_path(path: Optional[str] = None) -> str:
+    return path or os.environ.get(CONFIG_ENV) or DEFAULT_CONFIG
+
+
+@lru_cache(maxsize=None)
+def _load_settings(path: str) -> Settings:
+    if not os.path.exists(path):
+        raise SystemExit(f"Config file {path} not found")
+    if path == Settings.model_config['yaml_file']:
+        return Settings()
+    # yaml_file читается из model_config, поэтому другой путь — через подкласс
+    settings_cls = type('Settings', (Settings,), {'model_config': SettingsConfigDict(yaml_file=path)})
+    return settings_cls()
+
+
+def add_config_argument(parser):
+    parser.add_argument('--config', help=f"YAML settings, default ${CONFIG_ENV} or {DEFAULT_CONFIG}")
+
+
+def get_settings(path: Optional[str] = None) -> Settings:
+    """Настройки из YAML (по умолчанию $REESTR_CONFIG или config.yaml): файл читается
+    и проверяется один раз на процесс, дальше возвращается тот же объект."""
+    return _load_settings(config_path(path))
@@ -0,0 +1,296 @@
+# app/export.py
+"""Выгрузка собранных данных для аналитики: коды → имена → rawdata → images одной записью на имя.
+
+Строки читаются серверным курсором пачками по export.batch_size, поэтому память не зависит
+от размера таблиц. Каждый запуск пишет свою партицию exported_at=<время>/part-NNNNN.<формат>;
+она появляется под этим именем только после успешного завершения.
+
+Выгрузка инкрементальная: в <directory>/_state.json запоминается верхняя граница по
+names.updated_at (время сервера БД), и следующий запуск берёт только изменившиеся с тех пор
+имена — вместе с окном export.overlap_seconds перед границей. Имена из этого окна могут
+попасть в две соседние партиции; дубликаты отсекаются по (name, updated_at).
+
+    python -m app export --format parquet --files-dir export/files
+    python -m app export --full
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from loguru import logger
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app.config import ExportConfig, add_config_argument, get_settings
+from app.models.postgres import Code, Image, Name, Rawdata
+from app.storage.codec import decode_body, set_dictionary_dir
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet недоступен, jsonl работает и без pyarrow
+    pyarrow = None
+
+STATE_FILE = '_state.json'
+TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def _schema() -> 'pyarrow.Schema':
+    file_type = pyarrow.struct([('url', pyarrow.string()), ('file_id', pyarrow.string()),
+                                ('sha256', pyarrow.string())])
+    return pyarrow.schema([
+        ('code', pyarrow.string()), ('code_url', pyarrow.string()),
+        ('name', pyarrow.string()), ('url', pyarrow.string()), ('status', pyarrow.string()),
+        ('created_at', pyarrow.timestamp('us')), ('updated_at', pyarrow.timestamp('us')),
+        ('body', pyarrow.string()), ('files', pyarrow.list_(file_type)),
+    ])
+
+
+class JsonlWriter:
+    extension = 'jsonl'
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, records: List[dict]):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False, default=datetime.isoformat) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    extension = 'parquet'
+
+    def __init__(self, path: str):
+        self.schema = _schema()
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write(self, records: List[dict]):
+        # Одна пачка курсора — одна row group
+        self.writer.write_batch(pyarrow.RecordBatch.from_pylist(records, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+class PartitionWriter:
+    """Файлы part-NNNNN одной партиции, новый — каждые rows_per_file строк."""
+
+    def __init__(self, directory: str, writer_cls, rows_per_file: int):
+        self.directory = directory
+        self.writer_cls = writer_cls
+        self.rows_per_file = rows_per_file
+        self.writer = None
+        self.parts = 0
+        self.rows_in_part = 0
+        self.rows = 0
+
+    def write(self, records: List[dict]):
+        while records:
+            if self.writer is None:
+                path = os.path.join(self.directory, f'part-{self.parts:05d}.{self.writer_cls.extension}')
+                self.writer = self.writer_cls(path)
+                self.parts += 1
+            chunk = records[:self.rows_per_file - self.rows_in_part]
+            records = records[len(chunk):]
+            self.writer.write(chunk)
+            self.rows_in_part += len(chunk)
+            self.rows += len(chunk)
+            if self.rows_in_part >= self.rows_per_file:
+                self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.rows_in_part = 0
+
+
+class FileExporter:
+    """Копирует вложения из GridFS в <directory>/<sha256[:2]>/<sha256>: одинаковое содержимое
+    лежит один раз, а уже скопированное в прошлые запуски не скачивается."""
+
+    def __init__(self, mongo: 'MongoStorage', directory: str, workers: int):
+        self.mongo = mongo
+        self.directory = directory
+        self.semaphore = asyncio.Semaphore(workers)
+        self.hashes: Dict[str, str] = {}  # file_id → sha256 уже выгруженных в этом запуске
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    async def export(self, file_ids: List[str]) -> Dict[str, str]:
+        file_ids = [file_id for file_id in dict.fromkeys(file_ids) if file_id not in self.hashes]
+        if file_ids:
+            known = await self.mongo.file_hashes(file_ids)
+            await asyncio.gather(*(self._export_one(file_id, known.get(file_id)) for file_id in file_ids))
+        return self.hashes
+
+    async def _export_one(self, file_id: str, sha256: Optional[str]):
+        if sha256 and os.path.exists(self.path(sha256)):
+            self.hashes[file_id] = sha256
+            self.skipped += 1
+            return
+        # Хэш старых файлов известен только после скачивания — пишем во временный файл
+        tmp_path = os.path.join(self.directory, f'.{file_id}.tmp')
+        async with self.semaphore:
+            try:
+                with open(tmp_path, 'wb') as f:
+                    sha256 = await self.mongo.download(file_id, f)
+            except Exception as e:
+                logger.error(f"File {file_id} not exported: {e}")
+                self.failed += 1
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return
+        os.makedirs(os.path.dirname(self.path(sha256)), exist_ok=True)
+        os.replace(tmp_path, self.path(sha256))
+        self.hashes[file_id] = sha256
+        self.downloaded += 1
+
+
+def read_state(directory: str) -> Optional[datetime]:
+    try:
+        with open(os.path.join(directory, STATE_FILE), encoding='utf-8') as f:
+            return datetime.fromisoformat(json.load(f)['until'])
+    except FileNotFoundError:
+        return None
+
+
+def write_state(directory: str, until: datetime, partition: str, rows: int):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'until': until.isoformat(), 'partition': partition, 'rows': rows}, f)
+    os.replace(path + '.tmp', path)
+
+
+def names_query(statuses: List[str], since: Optional[datetime], until: datetime, include_body: bool):
+    columns = [Name.id, Code.code, Code.url.label('code_url'), Name.name, Name.url, Name.status,
+               Name.created_at, Name.updated_at]
+    if include_body:
+        columns += [Rawdata.body_html, Rawdata.body_zip, Rawdata.body_codec]
+    query = select(*columns).outerjoin(Code, Code.code == Name.product_code)
+    if include_body:
+        query = query.outerjoin(Rawdata, Rawdata.product_name == Name.name)
+    query = query.where(Name.status.in_(statuses), Name.updated_at <= until)
+    if since is not None:
+        query = query.where(Name.updated_at > since)
+    return query.order_by(Name.id)
+
+
+async def _images(session: AsyncSession, names: List[str]) -> Dict[str, List[dict]]:
+    result = await session.execute(
+        select(Image.product_name, Image.file_url, Image.file_id)
+        .where(Image.product_name.in_(names))
+        .order_by(Image.id)
+    )
+    images = {}
+    for product_name, file_url, file_id in result:
+        images.setdefault(product_name, []).append({'url': file_url, 'file_id': file_id, 'sha256': None})
+    return images
+
+
+async def export(engine, config: ExportConfig, mongo: Optional['MongoStorage'] = None, full: bool = False) -> int:
+    if config.format not in WRITERS:
+        raise SystemExit(f"Unknown export format {config.format!r}, expected one of {', '.join(WRITERS)}")
+    if config.format == 'parquet' and pyarrow is None:
+        raise SystemExit("Parquet export requires the 'pyarrow' package; use --format jsonl or install it")
+    os.makedirs(config.directory, exist_ok=True)
+    since = None if full else read_state(config.directory)
+    # Верхняя граница фиксируется до чтения: имена, изменённые во время выгрузки, попадут в следующую.
+    # Время — сервера БД, а не этой машины, как и у аренд в PostgresStorage
+    async with AsyncSession(engine) as session:
+        until = (await session.execute(select(func.timezone('UTC', func.now())))).scalar()
+    # Строки, закоммиченные после прошлой границы с более ранним updated_at, перечитываются
+    read_since = since - timedelta(seconds=config.overlap_seconds) if since else None
+    partition = f'exported_at={until.strftime(TIMESTAMP_FORMAT)}'
+    tmp_dir = os.path.join(config.directory, f'.{partition}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    files = None
+    if config.files_directory and mongo is not None:
+        os.makedirs(config.files_directory, exist_ok=True)
+        files = FileExporter(mongo, config.files_directory, config.file_workers)
+    writer = PartitionWriter(tmp_dir, WRITERS[config.format], config.rows_per_file)
+    logger.info(f"Exporting names {', '.join(config.statuses)} updated "
+                f"{'since ' + read_since.isoformat() if read_since else 'at any time'} to {partition}")
+    try:
+        async with AsyncSession(engine) as session:
+            query = names_query(config.statuses, read_since, until, config.include_body)
+            # Серверный курсор: в памяти не больше одной пачки
+            result = await session.stream(query.execution_options(yield_per=config.batch_size))
+            async for rows in result.partitions():
+                async with AsyncSession(engine) as images_session:
+                    images = await _images(images_session, [row.name for row in rows])
+                if files is not None:
+                    hashes = await files.export([image['file_id'] for row_images in images.values()
+                                                 for image in row_images if image['file_id']])
+                    for row_images in images.values():
+                        for image in row_images:
+                            image['sha256'] = hashes.get(image['file_id'])
+                records = []
+                for row in rows:
+                    record = {'code': row.code, 'code_url': row.code_url, 'name': row.name, 'url': row.url,
+                              'status': row.status, 'created_at': row.created_at, 'updated_at': row.updated_at,
+                              'body': None, 'files': images.get(row.name, [])}
+                    if config.include_body:
+                        record['body'] = (decode_body(row.body_zip, row.body_codec) if row.body_zip is not None
+                                          else row.body_html)
+                    records.append(record)
+                writer.write(records)
+                logger.info(f"Exported {writer.rows} names")
+    finally:
+        writer.close()
+    os.replace(tmp_dir, os.path.join(config.directory, partition))
+    write_state(config.directory, until, partition, writer.rows)
+    logger.info(f"Export done: {writer.rows} names in {writer.parts} files, {partition}")
+    if files is not None:
+        logger.info(f"Files: {files.downloaded} copied, {files.skipped} already exported, {files.failed} failed")
+    return writer.rows
+
+
+async def run(args):
+    settings = get_settings(args.config)
+    config = settings.export
+    overrides = {'format': args.format, 'directory': args.output, 'files_directory': args.files_dir}
+    config = config.model_copy(update={k: v for k, v in overrides.items() if v is not None})
+    if args.no_body:
+        config = config.model_copy(update={'include_body': False})
+    set_dictionary_dir(settings.rawdata.dictionary_dir)
+    mongo = None
+    if config.files_directory:
+        # motor и pymongo нужны только для вложений
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from app.storage.mongo import MongoStorage
+        mongodb = settings.database.mongodb
+        mongo = MongoStorage(AsyncIOMotorClient(mongodb.url), mongodb.database, mongodb.collection)
+    engine = create_async_engine(settings.database.postgres.url)
+    try:
+        await export(engine, config, mongo, args.full)
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Export crawled data to partitioned JSONL or Parquet")
+    add_config_argument(parser)
+    parser.add_argument('--format', choices=sorted(WRITERS), help="overrides export.format")
+    parser.add_argument('--output', help="overrides export.directory")
+    parser.add_argument('--files-dir', help="copy GridFS attachments here, overrides export.files_directory")
+    parser.add_argument('--no-body', action='store_true', help="skip rawdata bodies")
+    parser.add_argument('--full', action='store_true', help="ignore the saved state and export everything")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
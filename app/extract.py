@@ -0,0 +1,159 @@
+# app/extract.py
+"""Стадия извлечения полей: rawdata → products по правилам extraction.fields.
+
+Строки rawdata обходятся пачками по id, и разбираются только те, для которых в products
+ещё нет строки, у неё другой хэш тела (content_hash) или другой хэш правил (rules_hash).
+Поэтому повторный запуск почти ничего не делает, а после правки правил поля извлекаются
+заново из сохранённого HTML без единого запроса к сайту. Каждая пачка — отдельная
+транзакция, прерванный запуск можно просто повторить.
+
+    python -m app extract
+    python -m app extract --full --workers 8
+"""
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List
+from loguru import logger
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app.config import ExtractionConfig, add_config_argument, get_settings
+from app.models.postgres import Product, Rawdata, init_db
+from app.parsers.fields import ExtractedRow, compile_rules, extract_batch, init_worker, json_value, rules_hash
+
+# Строки, записанные до появления body_sha256, получают его при извлечении и в следующий раз не выбираются.
+# Core-UPDATE по таблице: ORM-вариант с дополнительным WHERE не поддерживает executemany
+BACKFILL_HASH = (
+    update(Rawdata.__table__)
+    .where(Rawdata.__table__.c.id == bindparam('rawdata_id'), Rawdata.__table__.c.body_sha256.is_(None))
+    .values(body_sha256=bindparam('hash'))
+)
+
+# Поля с собственными столбцами в products
+COLUMNS = {column.name for column in Product.__table__.columns} - {'id', 'product_name', 'fields', 'content_hash',
+                                                                   'rules_hash', 'extracted_at'}
+
+
+async def _candidates(session: AsyncSession, after_id: int, limit: int, rules: str, full: bool) -> list:
+    query = (
+        select(Rawdata.id, Rawdata.product_name, Rawdata.body_html, Rawdata.body_zip, Rawdata.body_codec)
+        .outerjoin(Product, Product.product_name == Rawdata.product_name)
+        .where(Rawdata.id > after_id, or_(Rawdata.body_html.isnot(None), Rawdata.body_zip.isnot(None)))
+    )
+    if not full:
+        query = query.where(or_(
+            Product.id.is_(None),
+            Rawdata.body_sha256.is_(None),
+            Product.content_hash.is_distinct_from(Rawdata.body_sha256),
+            Product.rules_hash.is_distinct_from(rules),
+        ))
+    result = await session.execute(query.order_by(Rawdata.id).limit(limit))
+    return [tuple(row) for row in result]
+
+
+def _product_row(row: ExtractedRow, rules: str, now: datetime) -> dict:
+    values = {column: row.values.get(column) for column in COLUMNS}
+    values.update(
+        product_name=row.product_name,
+        fields={name: json_value(value) for name, value in row.values.items() if name not in COLUMNS},
+        content_hash=row.body_sha256, rules_hash=rules, extracted_at=now,
+    )
+    return values
+
+
+async def _save(session: AsyncSession, extracted: List[ExtractedRow], rules: str):
+    now = datetime.utcnow()
+    rows = [_product_row(row, rules, now) for row in extracted]
+    stmt = insert(Product).values(rows)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[Product.product_name],
+        set_={column: stmt.excluded[column] for column in rows[0] if column != 'product_name'},
+    ))
+    await session.execute(BACKFILL_HASH, [{'rawdata_id': row.rawdata_id, 'hash': row.body_sha256}
+                                          for row in extracted])
+
+
+def _split(rows: list, parts: int) -> List[list]:
+    size = -(-len(rows) // parts)
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+async def extract(engine, config: ExtractionConfig, dictionary_dir: str, full: bool = False):
+    if not config.fields:
+        raise SystemExit("No extraction.fields configured")
+    fields = {name: rule.model_dump() for name, rule in config.fields.items()}
+    compile_rules(fields)  # ошибки в правилах — сразу, а не в каждом процессе пула
+    rules = rules_hash(fields)
+    # None — по числу ядер, 0 — в этом процессе без пула, как site.parse_workers
+    workers = (os.cpu_count() or 1) if config.workers is None else config.workers
+    await init_db(engine)
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    rows_done = 0
+    errors = {}
+    last_id = 0
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(fields, dictionary_dir))
+    else:
+        init_worker(fields, dictionary_dir)
+    try:
+        async with AsyncSession(engine) as session:
+            rows = await _candidates(session, last_id, config.batch_size, rules, full)
+        while rows:
+            last_id = rows[-1][0]
+            batch = rows
+            # Пока пул разбирает пачку, читаем следующую
+            parsing = None
+            if executor is not None:
+                parsing = asyncio.gather(*(loop.run_in_executor(executor, extract_batch, part)
+                                           for part in _split(batch, workers)))
+            async with AsyncSession(engine) as session:
+                rows = await _candidates(session, last_id, config.batch_size, rules, full)
+            if parsing is not None:
+                extracted = [row for part in await parsing for row in part]
+            else:
+                extracted = extract_batch(batch)
+            async with AsyncSession(engine) as session, session.begin():
+                await _save(session, extracted, rules)
+            for row in extracted:
+                for name in row.errors:
+                    errors[name] = errors.get(name, 0) + 1
+            rows_done += len(extracted)
+            logger.info(f"Extracted fields from {rows_done} rows, up to rawdata id {last_id}")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    elapsed = time.monotonic() - started
+    logger.info(f"Done in {elapsed:.0f}s: {rows_done} rows ({rows_done / max(elapsed, 1e-9):.1f}/s)")
+    if errors:
+        logger.warning(f"Values that did not match the field type: "
+                       f"{', '.join(f'{name} {count}' for name, count in sorted(errors.items()))}")
+
+
+async def run(args):
+    settings = get_settings(args.config)
+    config = settings.extraction
+    if args.workers is not None:
+        config = config.model_copy(update={'workers': args.workers})
+    engine = create_async_engine(settings.database.postgres.url)
+    try:
+        await extract(engine, config, settings.rawdata.dictionary_dir, args.full)
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Extract structured product fields from stored rawdata")
+    add_config_argument(parser)
+    parser.add_argument('--workers', type=int, help="overrides extraction.workers, 0 — parse in this process")
+    parser.add_argument('--full', action='store_true', help="re-extract every row, not only new or changed ones")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
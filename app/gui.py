@@ -1,28 +1,34 @@
 # app/gui.py
+import argparse
 import tkinter as tk
 from tkinter import scrolledtext
 from threading import Thread
+from collections import deque
+from queue import Empty, SimpleQueue
 import asyncio
+import time
 from loguru import logger
-import sys
-import io
+from app.config import add_config_argument, get_settings
 
 
-class LogCapture(io.StringIO):
-    def __init__(self, text_widget):
-        super().__init__()
-        self.text_widget = text_widget
+class ParserGUI:
+    """Окно мониторинга парсера.
 
-    def write(self, s):
-        super().write(s)
-        if s.strip():
-            self.text_widget.insert(tk.END, s)
-            self.text_widget.see(tk.END)
+    Парсер работает в своём потоке и виджеты Tk не трогает: статистика, строки лога и
+    смена состояния кладутся в SimpleQueue, а окно разбирает её пачкой раз в
+    gui.refresh_interval секунд через root.after.
+    """
 
+    # Сообщений за один тик: остаток разберётся на следующем, окно не подвисает
+    MAX_BATCH = 5000
+    # Окно, по которому считаются скорости pages/s и bytes/s, секунд
+    RATE_WINDOW = 10.0
 
-class ParserGUI:
     def __init__(self, settings):
         self.settings = settings
+        self.refresh_ms = max(int(settings.gui.refresh_interval * 1000), 50)
+        self.log_lines = settings.gui.log_lines
+        self.events = SimpleQueue()
         self.root = tk.Tk()
         self.root.title("Reestr Parser Monitor")
         self.root.geometry("800x600")
@@ -34,27 +40,35 @@ class ParserGUI:
                                     font=("Arial", 10))
         self.stats_label.pack()
 
+        self.rate_label = tk.Label(self.root, text="Pages/s: 0.0, KB/s: 0.0, Queues: codes 0, names 0",
+                                   font=("Arial", 10))
+        self.rate_label.pack()
+
         self.log_text = scrolledtext.ScrolledText(self.root, state='normal', height=20)
         self.log_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         self.start_button = tk.Button(self.root, text="Start", command=self.start_parser)
         self.start_button.pack(side=tk.LEFT, padx=10, pady=10)
 
-        self.stop_button = tk.Button(self.root, text="Stop", command=self.stop_parser, state='disabled')
+        self.stop_button = tk.Button(self.root, text="Stop", command=self._on_stop, state='disabled')
         self.stop_button.pack(side=tk.RIGHT, padx=10, pady=10)
 
         self.is_running = False
         self.parser_thread = None
+        self._samples = deque()  # (время, страниц, байт) за последние RATE_WINDOW секунд
+
+        # Redirect logs to GUI: sink только кладёт строку в очередь.
+        # Остальные sink'и (logging.file) не трогаем — stderr отключает setup_logging(console=False)
+        logger.add(self._log_sink, format="{time} {level} {message}", level="INFO")
 
-        # Redirect logs to GUI
-        self.log_capture = LogCapture(self.log_text)
-        logger.remove()  # Убираем стандартный вывод
-        logger.add(self.log_capture, format="{time} {level} {message}", level="INFO")
+    def _log_sink(self, message):
+        self.events.put(('log', str(message)))
 
     def start_parser(self):
         if self.is_running:
             return
         self.is_running = True
+        self._samples.clear()
         self.start_button.config(state='disabled')
         self.stop_button.config(state='normal')
         self.status_label.config(text="Status: Running...")
@@ -63,12 +77,17 @@ class ParserGUI:
         self.parser_thread.start()
 
     def stop_parser(self):
+        """Можно вызывать из любого потока: пайплайн увидит флаг, окно — сообщение в очереди."""
+        if not self.is_running:
+            return
         self.is_running = False
-        self.start_button.config(state='normal')
-        self.stop_button.config(state='disabled')
-        self.status_label.config(text="Status: Stopping...")
+        self.events.put(('status', "Stopping..."))
         logger.info("Stopping parser...")
 
+    def _on_stop(self):
+        self.stop_button.config(state='disabled')
+        self.stop_parser()
+
     def _run_parser(self):
         # Импортируем main_loop внутри функции, чтобы избежать циклической зависимости
         from app.main import main_loop
@@ -78,12 +97,85 @@ class ParserGUI:
             logger.error(f"Parser crashed: {e}")
         finally:
             self.is_running = False
+            self.events.put(('status', None))
+
+    def update_stats(self, **stats):
+        """Вызывается из потока парсера; окно покажет последний снимок на ближайшем тике."""
+        self.events.put(('stats', stats))
+
+    def _poll(self):
+        logs = deque(maxlen=self.log_lines)
+        stats = None
+        status, text = False, None
+        for _ in range(self.MAX_BATCH):
+            try:
+                kind, payload = self.events.get_nowait()
+            except Empty:
+                break
+            if kind == 'log':
+                logs.append(payload)
+            elif kind == 'stats':
+                stats = payload
+            else:
+                status, text = True, payload
+        if logs:
+            self._append_logs(logs)
+        if stats:
+            self._show_stats(stats)
+        if status:
+            self._show_status(text)
+        self.root.after(self.refresh_ms, self._poll)
+
+    def _append_logs(self, lines):
+        # Одна вставка на тик; в виджете остаются только последние log_lines строк
+        self.log_text.insert(tk.END, ''.join(lines))
+        total = int(self.log_text.index('end-1c').split('.')[0])
+        if total > self.log_lines:
+            self.log_text.delete('1.0', f'{total - self.log_lines + 1}.0')
+        self.log_text.see(tk.END)
+
+    def _show_stats(self, stats):
+        self.stats_label.config(
+            text=f"Stats: Codes: {stats.get('codes', 0)}, Names: {stats.get('names', 0)}, "
+                 f"Files: {stats.get('files', 0)}, Errors: {stats.get('errors', 0)}"
+        )
+        now = time.monotonic()
+        self._samples.append((now, stats.get('pages', 0), stats.get('bytes', 0)))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.RATE_WINDOW:
+            self._samples.popleft()
+        started, pages, size = self._samples[0]
+        elapsed = now - started
+        page_rate = (stats.get('pages', 0) - pages) / elapsed if elapsed else 0.0
+        byte_rate = (stats.get('bytes', 0) - size) / elapsed if elapsed else 0.0
+        self.rate_label.config(
+            text=f"Pages/s: {page_rate:.1f}, KB/s: {byte_rate / 1024:.1f}, "
+                 f"Queues: codes {stats.get('codes_queue', 0)}, names {stats.get('names_queue', 0)}"
+        )
+
+    def _show_status(self, text):
+        if text is None:
             self.start_button.config(state='normal')
             self.stop_button.config(state='disabled')
             self.status_label.config(text="Status: Idle")
-
-    def update_stats(self, codes=0, names=0, files=0, errors=0):
-        self.stats_label.config(text=f"Stats: Codes: {codes}, Names: {names}, Files: {files}, Errors: {errors}")
+        else:
+            self.stop_button.config(state='disabled')
+            self.status_label.config(text=f"Status: {text}")
 
     def run(self):
+        self.root.after(self.refresh_ms, self._poll)
         self.root.mainloop()
+
+
+def main(argv=None, prog=None):
+    from app.main import setup_logging
+
+    parser = argparse.ArgumentParser(prog=prog, description="Run the crawler with a monitoring window")
+    add_config_argument(parser)
+    args = parser.parse_args(argv)
+    settings = get_settings(args.config)
+    setup_logging(settings, console=False)
+    ParserGUI(settings).run()
+
+
+if __name__ == '__main__':
+    main()
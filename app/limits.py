@@ -0,0 +1,50 @@
+# app/limits.py
+import time
+from typing import Optional
+
+
+class RunBudget:
+    """Лимиты прогона на счётчиках в памяти: каждая проверка — O(1), без запросов к БД.
+
+    Счётчик rawdata при старте засевается оценкой размера таблицы из статистики Postgres,
+    поэтому лимит max_rawdata относится ко всей таблице, а не только к текущему прогону.
+    """
+
+    def __init__(self, config):
+        self.max_pages = config.max_pages
+        self.max_rawdata = config.max_rawdata
+        self.max_bytes = config.max_mb * 1024 * 1024 if config.max_mb else None
+        self.max_seconds = config.max_seconds
+        self.started = time.monotonic()
+        self.pages = 0
+        self.rawdata = 0
+        self.bytes = 0
+
+    def seed(self, rawdata: int):
+        self.rawdata = max(rawdata, 0)
+
+    def add_page(self, size: int):
+        self.pages += 1
+        self.bytes += size
+
+    def add_rawdata(self, count: int = 1):
+        self.rawdata += count
+
+    def add_bytes(self, size: int):
+        self.bytes += size
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def exceeded(self) -> Optional[str]:
+        """Причина остановки или None, если лимиты не исчерпаны."""
+        if self.max_pages is not None and self.pages >= self.max_pages:
+            return f"{self.pages} pages fetched"
+        if self.max_rawdata is not None and self.rawdata >= self.max_rawdata:
+            return f"{self.rawdata} rawdata entries"
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            return f"{self.bytes / 1024 / 1024:.1f} MB downloaded"
+        if self.max_seconds is not None and self.elapsed >= self.max_seconds:
+            return f"{self.elapsed:.0f}s wall time"
+        return None
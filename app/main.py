@@ -1,108 +1,87 @@
 # app/main.py
+"""Прогон парсера без окна — для серверов и контейнеров: python -m app crawl."""
+import argparse
 import asyncio
+import os
+import socket
+import sys
+from typing import Optional
 from loguru import logger
-from app.config import Settings
-from app.models.postgres import init_db, Rawdata
+from app.config import Settings, add_config_argument, get_settings
+from app.limits import RunBudget
+from app.metrics import metrics
+from app.models.postgres import create_engine, init_db
 from app.storage.postgres import PostgresStorage
 from app.storage.mongo import MongoStorage
 from app.parsers.fetcher import Fetcher
 from app.parsers.processor import Processor
-from motor.motor_asyncio import AsyncIOMotorClient
-from sqlalchemy import func
+from app.parsers.pipeline import Pipeline
 
 
-async def main_loop(settings: Settings, gui: 'ParserGUI' = None):
-    # Инициализация БД
-    async_session = await init_db(settings)
-    
-    # Подключение к MongoDB
-    mongo_client = AsyncIOMotorClient(settings.database.mongodb.url)
-    mongo_storage = MongoStorage(
-            client = mongo_client, db_name = settings.database.mongodb.database,
-            bucket_name = settings.database.mongodb.collection
-            )
-    
-    codes_processed = 0
-    names_processed = 0
-    files_downloaded = 0
-    errors = 0
-    
-    async with async_session() as session:
-        postgres_storage = PostgresStorage(session)
-        
-        async with Fetcher(settings) as fetcher:
-            processor = Processor(postgres_storage, mongo_storage, settings)
-            
-            # Шаг 1: Получить все ссылки с кодами (если еще не сохранены)
-            html = await fetcher.fetch(settings.site.base_url)
-            if html:
-                codes = processor.extract_codes_from_page(html)
-                for code, url in codes:
-                    await postgres_storage.save_code(code, url)
-                logger.info(f"Saved {len(codes)} codes to DB")
-            
-            # Шаг 2: Обработать все незавершенные коды
-            pending_codes = await postgres_storage.get_pending_codes()
-            for code_obj in pending_codes:
-                if not gui or not gui.is_running:
-                    logger.info("Parser stopped by user.")
-                    return
-                try:
-                    code_url = code_obj.url
-                    if not code_url.startswith('http'):
-                        code_url = settings.site.base_url.rstrip('/') + code_url
-                    html = await fetcher.fetch(code_url)
-                    if html:
-                        names = processor.extract_names_from_page(html, code_obj.code)
-                        for name, url, code in names:
-                            await postgres_storage.save_name(code, name, url)
-                        await postgres_storage.update_code_status(code_obj.id, 'done')
-                        codes_processed += 1
-                        if gui:
-                            gui.update_stats(codes = codes_processed, errors = errors)
-                except Exception as e:
-                    logger.error(f"Error processing code {code_obj.code}: {e}")
-                    await postgres_storage.update_code_status(code_obj.id, 'error')
-                    errors += 1
-                    if gui:
-                        gui.update_stats(errors = errors)
-            
-            # Шаг 3: Обработать все незавершенные имена
-            pending_names = await postgres_storage.get_pending_names()
-            for name_obj in pending_names:
-                if not gui or not gui.is_running:
-                    logger.info("Parser stopped by user.")
+async def main_loop(settings: Settings, gui: 'ParserGUI' = None, postgres: Optional[PostgresStorage] = None,
+                    mongo: Optional[MongoStorage] = None):
+    """Один прогон парсера. postgres и mongo можно подменить своими хранилищами
+    (например, в памяти — см. app/bench/storage.py); по умолчанию они строятся по settings."""
+    engine = None
+    if postgres is None:
+        # Инициализация БД: один пул соединений на процесс, сессии берутся из него на каждую операцию
+        engine = create_engine(settings)
+        async_session = await init_db(engine)
+        postgres_config = settings.database.postgres
+        queue_config = settings.queue
+        worker_id = queue_config.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        postgres = PostgresStorage(async_session, postgres_config.batch_size, postgres_config.flush_interval,
+                                   worker_id, queue_config.lease_seconds, queue_config.retry_delay)
+
+    if mongo is None:
+        # Подключение к MongoDB; motor импортируется только при создании клиента — хранилищам в памяти он не нужен
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo_client = AsyncIOMotorClient(settings.database.mongodb.url)
+        mongo = MongoStorage(
+                client = mongo_client, db_name = settings.database.mongodb.database,
+                bucket_name = settings.database.mongodb.collection,
+                upload_timeout = settings.site.file_timeout
+                )
+
+    await metrics.start(settings.metrics)
+    try:
+        # Хранилище закрывается первым: последняя пачка кладёт страницы в кэш HTTP через after_flush
+        async with Fetcher(settings) as fetcher, postgres as postgres_storage:
+            budget = RunBudget(settings.limits)
+            budget.seed(await postgres_storage.estimate_rawdata_count())
+            processor = Processor(postgres_storage, mongo, settings, fetcher, budget)
+            try:
+                pipeline = Pipeline(settings, fetcher, processor, postgres_storage, budget, gui)
+                if not await pipeline.run():
                     return
-                try:
-                    name_url = name_obj.url
-                    if not name_url.startswith('http'):
-                        name_url = settings.site.base_url.rstrip('/') + name_url
-                    html = await fetcher.fetch(name_url)
-                    if html:
-                        await processor.extract_and_save_body_html(html, name_obj.name)
-                        await processor.download_and_save_files(html, name_obj.name)
-                        await postgres_storage.update_name_status(name_obj.id, 'done')
-                        names_processed += 1
-                        files_downloaded += 1
-                        if gui:
-                            gui.update_stats(names = names_processed, files = files_downloaded, errors = errors)
-                        
-                        # ✅ Проверяем количество записей в Rawdata
-                        rawdata_count = await session.execute(
-                                func.count(Rawdata.id).select()
-                                )
-                        count = rawdata_count.scalar()
-                        if count >= 5:
-                            logger.info(f"Test limit reached: {count} rawdata entries. Stopping.")
-                            if gui:
-                                gui.stop_parser()  # Останавливаем GUI
-                            return
-                
-                except Exception as e:
-                    logger.error(f"Error processing name {name_obj.name}: {e}")
-                    await postgres_storage.update_name_status(name_obj.id, 'error')
-                    errors += 1
-                    if gui:
-                        gui.update_stats(errors = errors)
-    
-    logger.info("Parsing completed successfully.")
\ No newline at end of file
+            finally:
+                processor.close()
+    finally:
+        await metrics.stop()
+        if engine is not None:
+            await engine.dispose()
+
+    logger.info("Parsing completed successfully.")
+
+
+def setup_logging(settings: Settings, console: bool = True):
+    """Уровень логов из logging.level для консоли и logging.file с ротацией.
+    console=False — без вывода в stderr, например когда логи показывает окно GUI."""
+    logger.remove()
+    if console:
+        logger.add(sys.stderr, level=settings.logging.level)
+    if settings.logging.file:
+        logger.add(settings.logging.file, level=settings.logging.level, rotation='50 MB', retention=5)
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Run the crawler headless")
+    add_config_argument(parser)
+    args = parser.parse_args(argv)
+    settings = get_settings(args.config)
+    setup_logging(settings)
+    asyncio.run(main_loop(settings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# app/metrics.py
+import asyncio
+import json
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Tuple
+from loguru import logger
+
+# Верхние границы корзин гистограмм задержек, секунд
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+INF_LABEL = 'le="+Inf"'
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels_text(key: LabelKey, extra: str = '') -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам с линейной интерполяцией внутри корзины."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Span:
+    """Замер одной операции: длительность уходит в гистограмму стадии, а при включённой
+    трассировке — строкой в JSONL-файл."""
+
+    __slots__ = ('metrics', 'stage', 'url', 'started')
+
+    def __init__(self, metrics: 'Metrics', stage: str, url: Optional[str]):
+        self.metrics = metrics
+        self.stage = stage
+        self.url = url
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.record(self.stage, time.perf_counter() - self.started, self.url, exc_type)
+        return False
+
+
+class Metrics:
+    """Счётчики, гистограммы задержек по стадиям и gauges в памяти процесса.
+
+    Один экземпляр на процесс (`metrics`), как у loguru: стадии пишут в него напрямую,
+    не передавая объект через конструкторы. Всё вызывается из потока event loop.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, LabelKey], float] = {}
+        self.histograms: Dict[Tuple[str, LabelKey], Histogram] = {}
+        self.gauges: Dict[Tuple[str, LabelKey], Callable[[], float]] = {}
+        self.trace = None
+        self.started = time.monotonic()
+        self._runner = None
+        self._reporter = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float], **labels):
+        """Значение читается при каждом снятии метрик, например размер очереди."""
+        self.gauges[(name, _key(labels))] = func
+
+    def remove_gauges(self, name: str):
+        for key in [key for key in self.gauges if key[0] == name]:
+            del self.gauges[key]
+
+    def span(self, stage: str, url: Optional[str] = None) -> Span:
+        return Span(self, stage, url)
+
+    def record(self, stage: str, duration: float, url: Optional[str] = None, exc_type=None):
+        """Длительность стадии, измеренная вызывающим (например, сумма нескольких записей)."""
+        self.observe('stage_seconds', duration, stage=stage)
+        if self.trace is not None:
+            self.trace_span(stage, url, duration, exc_type)
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get((name, _key(labels)), 0)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self.histograms.get((name, _key(labels)))
+
+    # Трассировка
+
+    def open_trace(self, path: str):
+        self.close_trace()
+        self.trace = open(path, 'a', encoding='utf-8')
+
+    def close_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def trace_span(self, stage: str, url: Optional[str], duration: float, exc_type=None):
+        record = {'ts': round(time.time() - duration, 6), 'stage': stage, 'url': url,
+                  'duration': round(duration, 6)}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self.trace.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    # Вывод
+
+    def render(self) -> str:
+        """Метрики в текстовом формате Prometheus."""
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE reestr_{name}_total counter')
+            for (n, key), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f'reestr_{name}_total{_labels_text(key)} {value:g}')
+        for name in sorted({name for name, _ in self.gauges}):
+            lines.append(f'# TYPE reestr_{name} gauge')
+            for (n, key), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+                if n == name:
+                    lines.append(f'reestr_{name}{_labels_text(key)} {func():g}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE reestr_{name} histogram')
+            for (n, key), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = 'le="%g"' % bound
+                    lines.append(f'reestr_{name}_bucket{_labels_text(key, le)} {cumulative}')
+                lines.append(f'reestr_{name}_bucket{_labels_text(key, INF_LABEL)} {h.count}')
+                lines.append(f'reestr_{name}_sum{_labels_text(key)} {h.sum:.6f}')
+                lines.append(f'reestr_{name}_count{_labels_text(key)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        pages = self.counter('pages')
+        size = self.counter('bytes', kind='page') + self.counter('bytes', kind='file')
+        parts = [f"{pages:.0f} pages ({pages / elapsed:.2f}/s), {size / 1024 / 1024:.1f} MB",
+                 f"errors {sum(v for (n, _), v in self.counters.items() if n == 'errors'):.0f}",
+                 f"retries {sum(v for (n, _), v in self.counters.items() if n == 'retries'):.0f}"]
+        for (name, key), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name == 'stage_seconds':
+                stage = dict(key)['stage']
+                parts.append(f"{stage} p50 {h.quantile(0.5) * 1000:.0f}ms p99 {h.quantile(0.99) * 1000:.0f}ms "
+                             f"n={h.count}")
+        for (name, key), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+            if name == 'queue_depth':
+                parts.append(f"queue {dict(key)['queue']} {func():g}")
+        return '; '.join(parts)
+
+    async def log_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"Metrics: {self.summary()}")
+
+    async def start(self, config):
+        """Эндпоинт, периодическая сводка и трассировка по MetricsConfig."""
+        if config.trace_file:
+            self.open_trace(config.trace_file)
+        if config.summary_interval > 0:
+            self._reporter = asyncio.create_task(self.log_periodically(config.summary_interval))
+        if config.port:
+            try:
+                self._runner = await self.serve(config.host, config.port)
+            except OSError as e:
+                logger.warning(f"Metrics endpoint on {config.host}:{config.port} is unavailable: {e}")
+
+    async def stop(self):
+        if self._reporter:
+            self._reporter.cancel()
+            await asyncio.gather(self._reporter, return_exceptions=True)
+            self._reporter = None
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        self.close_trace()
+        logger.info(f"Metrics: {self.summary()}")
+
+    async def serve(self, host: str, port: int):
+        """Поднимает /metrics на aiohttp.web; возвращает runner, который нужно закрыть через cleanup()."""
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+        return runner
+
+
+metrics = Metrics()
@@ -9,3 +9,10 @@ class FileMetadata(BaseModel):
     filename: Optional[str] = None
     content_type: Optional[str] = None
     size: Optional[int] = None
+    sha256: Optional[str] = None
+
+
+class StoredFile(BaseModel):
+    file_id: str
+    size: int
+    sha256: str
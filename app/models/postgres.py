@@ -1,8 +1,17 @@
 # app/models/postgres.py
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import (
+    JSON, Column, Date, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, String, Text, delete, event, func,
+    select, text
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
+from loguru import logger
+from typing import Optional
+import hashlib
+from app.metrics import metrics
+from app.storage.codec import decode_body
 
 Base = declarative_base()
 
@@ -13,12 +22,21 @@ class Code(Base):
     id = Column(Integer, primary_key=True, index=True)
     code = Column(String, unique=True, index=True)
     url = Column(String, unique=True)
-    status = Column(String, default='pending')  # pending, done, error
+    # pending → fetched (страница получена, её имена сохранены в той же транзакции); retry, error
+    status = Column(String, default='pending')
+    attempts = Column(Integer, default=0, server_default='0', nullable=False)  # неудачных попыток
+    # Аренда строки воркером: пока locked_until в будущем, другие процессы её не берут
+    locked_by = Column(String)
+    locked_until = Column(DateTime)  # UTC
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     names = relationship("Name", back_populates="code_obj")
 
+    __table_args__ = (
+        Index('ix_codes_claimable', 'id', postgresql_where=text("status IN ('pending', 'retry')")),
+    )
+
 
 class Name(Base):
     __tablename__ = 'names'
@@ -27,42 +45,215 @@ class Name(Base):
     product_code = Column(String, ForeignKey('codes.code'))
     name = Column(String, unique=True, index=True)
     url = Column(String, unique=True)
+    # pending → parsed (rawdata и список файлов сохранены) → stored (все файлы в GridFS); retry, error
     status = Column(String, default='pending')
+    attempts = Column(Integer, default=0, server_default='0', nullable=False)
+    locked_by = Column(String)
+    locked_until = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # По нему выбирает изменения инкрементальная выгрузка (app/export.py)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     code_obj = relationship("Code", back_populates="names")
     rawdata = relationship("Rawdata", back_populates="name_obj")
     images = relationship("Image", back_populates="name_obj")
 
+    __table_args__ = (
+        Index('ix_names_resumable', 'id', postgresql_where=text("status IN ('pending', 'retry', 'parsed')")),
+    )
+
 
 class Rawdata(Base):
     __tablename__ = 'rawdata'
 
     id = Column(Integer, primary_key=True, index=True)
     product_name = Column(String, ForeignKey('names.name'))
-    body_html = Column(Text)
+    body_html = Column(Text)  # NULL, если тело хранится сжатым
+    body_zip = Column(LargeBinary)
+    body_codec = Column(String)  # zlib, zstd или zstd:<dict_id>, см. app/storage/codec.py
+    body_sha256 = Column(String)  # хэш несжатого тела; NULL у строк, записанных до его появления
     created_at = Column(DateTime, default=datetime.utcnow)
 
     name_obj = relationship("Name", back_populates="rawdata")
 
+    @property
+    def body(self) -> Optional[str]:
+        """HTML страницы независимо от того, сжат он или нет."""
+        if self.body_zip is not None:
+            return decode_body(self.body_zip, self.body_codec)
+        return self.body_html
+
+    __table_args__ = (Index('uq_rawdata_product_name', 'product_name', unique=True),)
+
 
 class Image(Base):
     __tablename__ = 'images'
 
     id = Column(Integer, primary_key=True, index=True)
     product_name = Column(String, ForeignKey('names.name'))
-    file_id = Column(String)  # ID файла в MongoDB
+    file_id = Column(String)  # ID файла в MongoDB; NULL — файл найден на странице, но ещё не скачан
     file_url = Column(String)  # оригинальная ссылка
     created_at = Column(DateTime, default=datetime.utcnow)
 
     name_obj = relationship("Name", back_populates="images")
 
+    __table_args__ = (Index('uq_images_product_name_file_url', 'product_name', 'file_url', unique=True),)
+
+
+class Product(Base):
+    """Поля товара, извлечённые из rawdata правилами extraction.fields (python -m app.extract)."""
+    __tablename__ = 'products'
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_name = Column(String, ForeignKey('names.name'), unique=True)
+    # Поля с этими именами пишутся в свои столбцы, остальные — в fields
+    producer = Column(String)
+    volume = Column(Float)  # литров
+    abv = Column(Float)  # крепость, % об.
+    registered_at = Column(Date)
+    valid_until = Column(Date)
+    fields = Column(JSON)
+    content_hash = Column(String)  # rawdata.body_sha256, из которого извлечены поля
+    rules_hash = Column(String)  # хэш правил: после их изменения строка извлекается заново
+    extracted_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class Checkpoint(Base):
+    """Отметки о завершённых шагах прогона, например об обходе индексной страницы."""
+    __tablename__ = 'checkpoints'
+
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # UTC
+
+
+# create_all не меняет уже существующие таблицы — эти идемпотентные операторы
+# догоняют схему старых баз при каждом запуске.
+MIGRATIONS = [
+    # Дубликаты, мешающие этим индексам, перед ними удаляет _drop_duplicates
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_rawdata_product_name ON rawdata (product_name)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_images_product_name_file_url ON images (product_name, file_url)",
+    "ALTER TABLE codes ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE names ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE codes ADD COLUMN IF NOT EXISTS locked_by VARCHAR",
+    "ALTER TABLE codes ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE names ADD COLUMN IF NOT EXISTS locked_by VARCHAR",
+    "ALTER TABLE names ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE rawdata ADD COLUMN IF NOT EXISTS body_zip BYTEA",
+    "ALTER TABLE rawdata ADD COLUMN IF NOT EXISTS body_codec VARCHAR",
+    "ALTER TABLE rawdata ADD COLUMN IF NOT EXISTS body_sha256 VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_codes_claimable ON codes (id) WHERE status IN ('pending', 'retry')",
+    "CREATE INDEX IF NOT EXISTS ix_names_resumable ON names (id) WHERE status IN ('pending', 'retry', 'parsed')",
+    "DROP INDEX IF EXISTS ix_names_claimable",
+    "CREATE INDEX IF NOT EXISTS ix_names_updated_at ON names (updated_at)",
+    # Статус done разделился на fetched (коды) и stored (имена); переименование — один раз
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM checkpoints WHERE key = 'migration:statuses') THEN
+            UPDATE codes SET status = 'fetched' WHERE status = 'done';
+            UPDATE names SET status = 'stored' WHERE status = 'done';
+            INSERT INTO checkpoints (key, value, updated_at)
+                VALUES ('migration:statuses', 'done', timezone('UTC', now()));
+        END IF;
+    END $$
+    """,
+]
+
+# Ключ pg_advisory_xact_lock: схему обновляет один процесс, остальные ждут его коммита
+MIGRATION_LOCK = 0x7265657374720001
+# Версия схемы — таблицы моделей и тексты миграций. Пока она совпадает с записанной в checkpoints,
+# DDL не выполняется: ALTER TABLE берёт ACCESS EXCLUSIVE даже ради IF NOT EXISTS
+SCHEMA_VERSION = hashlib.sha256('\n'.join(sorted(Base.metadata.tables) + MIGRATIONS).encode('utf-8')).hexdigest()
+SCHEMA_CHECKPOINT = 'migration:schema'
+# Уникальные индексы, добавленные к уже заполненным таблицам: индекс → (таблица, столбцы)
+UNIQUE_INDEXES = {
+    'uq_rawdata_product_name': (Rawdata.__table__, ('product_name',)),
+    'uq_images_product_name_file_url': (Image.__table__, ('product_name', 'file_url')),
+}
+
 
 # Session setup
-async def init_db(settings):
-    engine = create_async_engine(settings.database.postgres.url, echo=settings.database.postgres.echo)
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc('db_statements')
+
+
+def create_engine(settings) -> AsyncEngine:
+    config = settings.database.postgres
+    engine = create_async_engine(
+        config.url,
+        echo=config.echo,
+        pool_size=config.pool_size,
+        max_overflow=config.max_overflow,
+        pool_timeout=config.pool_timeout,
+        pool_recycle=config.pool_recycle,
+        pool_pre_ping=config.pool_pre_ping,
+        # кэш подготовленных выражений: asyncpg на соединение и SQLAlchemy поверх него
+        connect_args={
+            'statement_cache_size': config.statement_cache_size,
+            'prepared_statement_cache_size': config.statement_cache_size,
+        },
+    )
+    # Каждый запрос к серверу (executemany — один) попадает в счётчик db_statements
+    event.listen(engine.sync_engine, 'before_cursor_execute', _count_statement)
+    return engine
+
+
+async def _schema_version(conn) -> Optional[str]:
+    if await conn.scalar(text("SELECT to_regclass('checkpoints')")) is None:
+        return None
+    return await conn.scalar(select(Checkpoint.value).where(Checkpoint.key == SCHEMA_CHECKPOINT))
+
+
+async def _drop_duplicates(conn):
+    """Удаляет строки, из-за которых не создаётся индекс UNIQUE_INDEXES, — кроме самой старой.
+    Это потеря данных, поэтому удалённые строки и оставшиеся без ссылок файлы GridFS пишутся в лог."""
+    for index, (table, columns) in UNIQUE_INDEXES.items():
+        if await conn.scalar(text('SELECT to_regclass(:name)'), {'name': index}) is not None:
+            continue
+        duplicate, kept = table.alias('duplicate'), table.alias('kept')
+        returning = [duplicate.c.id, *(duplicate.c[column] for column in columns)]
+        if 'file_id' in table.c:
+            returning.append(duplicate.c.file_id)
+        result = await conn.execute(
+            delete(duplicate)
+            .where(*(duplicate.c[column] == kept.c[column] for column in columns), duplicate.c.id > kept.c.id)
+            .returning(*returning)
+        )
+        removed = result.all()
+        if not removed:
+            continue
+        logger.warning(f"Removed {len(removed)} duplicate {table.name} rows before creating {index}: "
+                       f"{', '.join(str(tuple(row)) for row in removed)}")
+        file_ids = {row.file_id for row in removed if 'file_id' in row._fields and row.file_id}
+        if file_ids:
+            result = await conn.execute(select(table.c.file_id).where(table.c.file_id.in_(file_ids)))
+            orphaned = file_ids - set(result.scalars())
+            if orphaned:
+                logger.warning(f"GridFS files no longer referenced from {table.name}: {', '.join(sorted(orphaned))}")
+
+
+async def migrate(conn):
+    """Создаёт таблицы и применяет MIGRATIONS, если схема в БД старше кода.
+
+    Воркеры стартуют одновременно, поэтому всё идёт под advisory lock в транзакции conn:
+    схему обновляет первый процесс, остальные после его коммита видят новую версию и DDL не выполняют.
+    """
+    await conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK})
+    if await _schema_version(conn) == SCHEMA_VERSION:
+        return
+    logger.info("Updating database schema")
+    await conn.run_sync(Base.metadata.create_all)
+    await _drop_duplicates(conn)
+    for statement in MIGRATIONS:
+        await conn.execute(text(statement))
+    stmt = insert(Checkpoint).values(key=SCHEMA_CHECKPOINT, value=SCHEMA_VERSION,
+                                     updated_at=func.timezone('UTC', func.now()))
+    await conn.execute(stmt.on_conflict_do_update(index_elements=[Checkpoint.key],
+                                                  set_={'value': stmt.excluded.value,
+                                                        'updated_at': stmt.excluded.updated_at}))
+
+
+async def init_db(engine: AsyncEngine) -> async_sessionmaker:
     async with engine.begin() as conn:
-        # Create tables
-        await conn.run_sync(Base.metadata.create_all)
-    return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        await migrate(conn)
+    return async_sessionmaker(engine, expire_on_commit=False)
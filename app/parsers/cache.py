@@ -0,0 +1,110 @@
+# app/parsers/cache.py
+import hashlib
+import os
+import sqlite3
+import time
+from typing import NamedTuple, Optional
+from loguru import logger
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    sha256: str
+    encoding: Optional[str]
+    size: int
+
+
+class ResponseCache:
+    """Дисковый кэш ответов по URL для повторных обходов.
+
+    Индекс (валидаторы, хэш содержимого, время доступа) лежит в SQLite, тела страниц —
+    отдельными файлами. В кэш попадают только успешно обработанные страницы, поэтому
+    «не изменилась» означает «уже разобрана и сохранена».
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, sha256 TEXT NOT NULL, '
+            'encoding TEXT, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.stats = {'not_modified': 0, 'unchanged': 0, 'changed': 0, 'miss': 0, 'evicted': 0}
+
+    @staticmethod
+    def content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        row = self.db.execute(
+            'SELECT url, etag, last_modified, sha256, encoding, size FROM entries WHERE url = ?', (url,)
+        ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def read(self, url: str) -> Optional[bytes]:
+        try:
+            with open(self._path(url), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        self.db.execute('UPDATE entries SET accessed = ? WHERE url = ?', (time.time(), url))
+        return content
+
+    def put(self, url: str, content: bytes, etag: Optional[str], last_modified: Optional[str],
+            encoding: Optional[str]):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        old = self.get(url)
+        self.db.execute(
+            'INSERT OR REPLACE INTO entries (url, etag, last_modified, sha256, encoding, size, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (url, etag, last_modified, self.content_hash(content), encoding, len(content), time.time())
+        )
+        self.total_size += len(content) - (old.size if old else 0)
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока кэш не станет меньше 90% лимита."""
+        target = self.max_size * 0.9
+        rows = self.db.execute('SELECT url, size FROM entries ORDER BY accessed').fetchall()
+        for url, size in rows:
+            if self.total_size <= target:
+                break
+            try:
+                os.remove(self._path(url))
+            except OSError:
+                pass
+            self.db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            self.total_size -= size
+            self.stats['evicted'] += 1
+
+    def report(self):
+        s = self.stats
+        hits = s['not_modified'] + s['unchanged']
+        total = hits + s['changed'] + s['miss']
+        ratio = hits / total * 100 if total else 0
+        logger.info(
+            f"HTTP cache: {hits}/{total} hits ({ratio:.1f}%): 304 {s['not_modified']}, "
+            f"same content {s['unchanged']}; changed {s['changed']}, miss {s['miss']}, "
+            f"evicted {s['evicted']}, size {self.total_size / 1024 / 1024:.1f} MB"
+        )
+
+    def close(self):
+        self.db.close()
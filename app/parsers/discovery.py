@@ -0,0 +1,188 @@
+# app/parsers/discovery.py
+"""Обход каталога кодов. Обычно запускается из Pipeline вместе с обработкой кодов;
+отдельный запуск заполняет только очередь кодов, например несколькими шардами на разных машинах:
+
+    python -m app discover --shard 0/4
+"""
+import argparse
+import asyncio
+import re
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urldefrag
+from loguru import logger
+from app.config import Settings, add_config_argument, get_settings
+from app.limits import RunBudget
+from app.metrics import metrics
+from app.models.postgres import create_engine, init_db
+from app.parsers.fetcher import Fetcher, FetchError, Page
+from app.parsers.processor import Processor
+from app.parsers.scheduler import Scheduler
+from app.storage.postgres import PostgresStorage
+from app.utils import absolute_url
+
+# Подставляется вместо номера страницы в шаблон URL пагинации
+PAGE_MARK = '\x00'
+
+
+class Discovery:
+    """Обход каталога: индекс, разделы (tags.codes_page.category_selector) и страницы
+    пагинации (tags.codes_page.pagination_selector) загружаются параллельно, найденные коды
+    пишутся в БД пачками.
+
+    Повторы отсекаются до БД множеством уже виденных URL страниц и кодов. По номеру
+    из tags.codes_page.page_pattern пропущенные страницы списка достраиваются до наибольшего
+    увиденного номера, поэтому хватает ссылки на последнюю страницу.
+
+    При shard_count > 1 процесс загружает только страницы списка с номером
+    N % shard_count == shard_index; индекс и первые страницы разделов нужны всем шардам,
+    чтобы узнать число страниц, и загружаются каждым из них.
+    """
+
+    def __init__(self, settings, fetcher: Fetcher, processor: Processor, postgres: PostgresStorage,
+                 budget: RunBudget):
+        self.settings = settings
+        self.fetcher = fetcher
+        self.processor = processor
+        self.postgres = postgres
+        self.budget = budget
+        config = settings.discovery
+        self.batch_size = config.batch_size
+        self.max_pages = config.max_pages
+        self.shard_index = config.shard_index
+        self.shard_count = max(config.shard_count, 1)
+        self.page_re = re.compile(settings.tags.codes_page.page_pattern)
+        self.listings = Scheduler(self.process_listing, config.workers or settings.site.max_workers,
+                                  name='listings')
+        self.seen_urls = set()
+        self.seen_codes = set()
+        self.last_page: Dict[str, int] = {}  # шаблон URL списка → наибольший известный номер страницы
+        self._codes: List[Tuple[str, str]] = []
+        self._pages: List[Page] = []  # в кэш — после сохранения их кодов
+        self.pages = 0
+        self.codes_found = 0
+        self.codes_inserted = 0
+        self.errors = 0
+
+    @property
+    def checkpoint(self) -> str:
+        key = f'index:{self.settings.site.base_url}'
+        if self.shard_count > 1:
+            key += f':{self.shard_index}/{self.shard_count}'
+        return key
+
+    @property
+    def stopped(self) -> bool:
+        return self.listings.stopped
+
+    def stop(self):
+        self.listings.stop()
+
+    async def run(self) -> bool:
+        """Возвращает False, если обход был остановлен до конца."""
+        self.listings.start()
+        metrics.gauge('queue_depth', self.listings.queue.qsize, queue='listings')
+        await self._enqueue(self.settings.site.base_url)
+        await self.listings.join()
+        # Отметка об обходе ставится вместе с последней пачкой кодов — только если он завершён
+        await self._flush(self.checkpoint if not self.stopped and not self.errors else None)
+        logger.info(f"Discovery: {self.pages} listing pages, {self.codes_found} codes found, "
+                    f"{self.codes_inserted} new, {self.errors} pages failed")
+        return not self.stopped
+
+    def _owns(self, number: Optional[int]) -> bool:
+        # Страницы без номера (индекс, разделы) загружает каждый шард
+        return number is None or number % self.shard_count == self.shard_index
+
+    async def _enqueue(self, url: str, number: Optional[int] = None):
+        url = urldefrag(url)[0]
+        if url in self.seen_urls or not self._owns(number):
+            return
+        if self.max_pages is not None and len(self.seen_urls) >= self.max_pages:
+            return
+        self.seen_urls.add(url)
+        await self.listings.submit(url)
+
+    async def _follow_pagination(self, url: str):
+        match = self.page_re.search(url)
+        if not match:
+            await self._enqueue(url, 0)
+            return
+        template = url[:match.start(1)] + PAGE_MARK + url[match.end(1):]
+        number = int(match.group(1))
+        last = self.last_page.get(template, 1)
+        if number <= last:
+            return
+        self.last_page[template] = number
+        for n in range(last + 1, number + 1):
+            await self._enqueue(template.replace(PAGE_MARK, str(n)), n)
+
+    async def process_listing(self, url: str):
+        try:
+            page = await self.fetcher.fetch(url)
+            self.budget.add_page(len(page.content))
+            listing = await self.processor.parse_listing_page(page)
+        except FetchError as e:
+            logger.error(f"Listing page {url} failed: {e}")
+            metrics.inc('errors', stage='listing')
+            self.errors += 1
+            return
+        self.pages += 1
+        base_url = self.settings.site.base_url
+        # Коды неизменившейся страницы тоже пишутся: кэш HTTP не гарантирует, что они есть в этой БД,
+        # а уже сохранённые отсекает ON CONFLICT
+        for code, href in self.processor.codes_from_links(listing.code_links):
+            if code not in self.seen_codes:
+                self.seen_codes.add(code)
+                self._codes.append((code, href))
+        self._pages.append(page)
+        if len(self._codes) >= self.batch_size:
+            await self._flush()
+        for href in listing.category_links:
+            await self._enqueue(absolute_url(base_url, href))
+        for href in listing.page_links:
+            await self._follow_pagination(absolute_url(base_url, href))
+        if self.budget.exceeded():
+            self.stop()
+
+    async def _flush(self, checkpoint: Optional[str] = None):
+        codes, self._codes = self._codes, []
+        pages, self._pages = self._pages, []
+        if codes or checkpoint:
+            self.codes_found += len(codes)
+            self.codes_inserted += await self.postgres.save_codes_bulk(codes, checkpoint)
+        for page in pages:
+            self.fetcher.remember(page)
+
+
+async def run(settings: Settings):
+    engine = create_engine(settings)
+    try:
+        config = settings.database.postgres
+        async with PostgresStorage(await init_db(engine), config.batch_size, config.flush_interval) as postgres, \
+                Fetcher(settings) as fetcher:
+            budget = RunBudget(settings.limits)
+            # Страницы списков не качают файлы — MongoDB не нужна
+            processor = Processor(postgres, None, settings, fetcher, budget)
+            try:
+                await Discovery(settings, fetcher, processor, postgres, budget).run()
+            finally:
+                processor.close()
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Discover product codes and queue them in Postgres")
+    add_config_argument(parser)
+    parser.add_argument('--shard', help="i/n — crawl only listing pages N with N %% n == i")
+    args = parser.parse_args(argv)
+    settings = get_settings(args.config)
+    if args.shard:
+        index, count = (int(part) for part in args.shard.split('/'))
+        discovery = settings.discovery.model_copy(update={'shard_index': index, 'shard_count': count})
+        settings = settings.model_copy(update={'discovery': discovery})
+    asyncio.run(run(settings))
+
+
+if __name__ == '__main__':
+    main()
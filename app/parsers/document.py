@@ -0,0 +1,151 @@
+# app/parsers/document.py
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+from loguru import logger
+import lxml.html
+from lxml import etree
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:  # нет пакета cssselect — работаем только через BeautifulSoup
+    CSSSelector = None
+
+
+@lru_cache(maxsize=None)
+def compile_selector(css: str) -> Optional['CSSSelector']:
+    """CSS → XPath компилируется один раз на селектор. None — использовать BeautifulSoup."""
+    if CSSSelector is None:
+        return None
+    try:
+        return CSSSelector(css, translator='html')
+    except Exception as e:
+        logger.warning(f"Selector {css!r} is not supported by lxml, falling back to BeautifulSoup: {e}")
+        return None
+
+
+class Document:
+    """Страница, разобранная один раз и общая для всех экстракторов.
+
+    Основной путь — дерево lxml.html и скомпилированные селекторы; BeautifulSoup строится
+    лениво и только если lxml не справился с разметкой или селектором.
+    """
+
+    def __init__(self, html: Union[str, bytes], encoding: Optional[str] = None):
+        self.html = html
+        self.encoding = encoding
+        self._soup = None
+        parser = lxml.html.HTMLParser(encoding=encoding) if encoding and isinstance(html, bytes) else None
+        try:
+            self.tree = lxml.html.document_fromstring(html, parser=parser)
+        except (etree.ParserError, ValueError) as e:
+            logger.warning(f"lxml failed to parse page, falling back to BeautifulSoup: {e}")
+            self.tree = None
+
+    @property
+    def soup(self) -> 'BeautifulSoup':
+        if self._soup is None:
+            # bs4 импортируется только при первом откате с lxml — на старте его не грузим
+            from bs4 import BeautifulSoup
+            if isinstance(self.html, bytes):
+                self._soup = BeautifulSoup(self.html, 'lxml', from_encoding=self.encoding)
+            else:
+                self._soup = BeautifulSoup(self.html, 'lxml')
+        return self._soup
+
+    def _select(self, css: str):
+        selector = compile_selector(css) if self.tree is not None else None
+        if selector is None:
+            return self.soup.select(css), False
+        return selector(self.tree), True
+
+    def links(self, css: str) -> List[Tuple[str, str]]:
+        """Пары (href, текст ссылки) для элементов с непустым href."""
+        elements, fast = self._select(css)
+        result = []
+        for el in elements:
+            href = el.get('href')
+            if not href:
+                continue
+            if fast:
+                title = ''.join(part.strip() for part in el.itertext())
+            else:
+                title = el.get_text(strip=True)
+            result.append((href, title))
+        return result
+
+    def urls(self, css: str, attrs: Tuple[str, ...] = ('href', 'src')) -> List[str]:
+        """Первое непустое значение из attrs для каждого элемента."""
+        elements, _ = self._select(css)
+        result = []
+        for el in elements:
+            for attr in attrs:
+                value = el.get(attr)
+                if value:
+                    result.append(value)
+                    break
+        return result
+
+    def first(self, css: str, attr: Optional[str] = None) -> Optional[str]:
+        """Текст первого подходящего элемента или значение его атрибута attr."""
+        elements, fast = self._select(css)
+        if not elements:
+            return None
+        el = elements[0]
+        if attr:
+            return el.get(attr)
+        return ' '.join(el.itertext()) if fast else el.get_text(' ')
+
+    def body_html(self, strip: Sequence[str] = ()) -> Optional[str]:
+        """<body> страницы без элементов, подходящих под селекторы strip."""
+        if self.tree is not None:
+            body = self.tree.find('body')
+            if body is not None:
+                for css in strip:
+                    selector = compile_selector(css)
+                    if selector is None:
+                        break
+                    for el in selector(body):
+                        el.drop_tree()
+                else:
+                    return etree.tostring(body, encoding='unicode', method='html', with_tail=False)
+        body = self.soup.find('body')
+        if not body:
+            return None
+        for css in strip:
+            for el in body.select(css):
+                el.decompose()
+        return str(body)
+
+
+class ProductPage(NamedTuple):
+    body_html: Optional[str]
+    file_urls: List[str]
+
+
+class ListingPage(NamedTuple):
+    code_links: List[str]
+    category_links: List[str]
+    page_links: List[str]
+
+
+# Функции ниже выполняются в пуле процессов: принимают сырые байты и возвращают
+# только компактный результат, а не дерево документа.
+
+def extract_links(content: bytes, encoding: Optional[str], css: str) -> List[Tuple[str, str]]:
+    return Document(content, encoding).links(css)
+
+
+def extract_listing(content: bytes, encoding: Optional[str], links_css: str, category_css: Optional[str],
+                    pagination_css: Optional[str]) -> ListingPage:
+    doc = Document(content, encoding)
+    return ListingPage(doc.urls(links_css, ('href',)),
+                       doc.urls(category_css, ('href',)) if category_css else [],
+                       doc.urls(pagination_css, ('href',)) if pagination_css else [])
+
+
+def extract_product(content: bytes, encoding: Optional[str], file_css: str,
+                    strip: Sequence[str] = ()) -> ProductPage:
+    doc = Document(content, encoding)
+    # Ссылки на файлы собираются до вырезания блоков из дерева
+    file_urls = doc.urls(file_css)
+    return ProductPage(doc.body_html(strip), file_urls)
@@ -1,38 +1,218 @@
 # app/parsers/fetcher.py
 import asyncio
+import random
+import time
 import aiohttp
-from bs4 import BeautifulSoup
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, NamedTuple, Optional, Tuple
 from loguru import logger
+from app.metrics import metrics
+from app.parsers.cache import ResponseCache
+from app.parsers.scheduler import AdaptiveRateLimiter, RateLimiter
+
+
+class Page(NamedTuple):
+    url: str
+    content: bytes
+    encoding: str
+    unchanged: bool = False  # совпадает с копией в кэше: 304 или тот же хэш содержимого
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class FetchError(Exception):
+    """Страницу не удалось получить. retryable — стоит попробовать в следующий раз."""
+
+    def __init__(self, url: str, reason: str, retryable: bool):
+        super().__init__(f"{url}: {reason}")
+        self.url = url
+        self.retryable = retryable
+
+
+# 429/503 — сервер просит притормозить, остальные 5xx и 408 — временные сбои
+THROTTLE_STATUSES = {429, 503}
+RETRYABLE_STATUSES = {408, 500, 502, 504} | THROTTLE_STATUSES
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
 
 
 class Fetcher:
     def __init__(self, settings):
         self.settings = settings
         self.session = None
+        site = settings.site
+        rate = site.requests_per_second
+        if rate is None and site.delay_between_requests > 0:
+            rate = 1 / site.delay_between_requests
+        if site.max_requests_per_second and rate:
+            self.limiter = AdaptiveRateLimiter(rate, min(site.min_requests_per_second, rate),
+                                               max(site.max_requests_per_second, rate))
+        else:
+            self.limiter = RateLimiter(rate)
+        cache = settings.http_cache
+        self.cache = ResponseCache(cache.directory, cache.max_size_mb * 1024 * 1024) if cache.enabled else None
+        self.file_timeout = aiohttp.ClientTimeout(total=site.file_timeout, sock_read=site.page_timeout)
+        self.connection_stats = {'created': 0, 'reused': 0, 'dns_hits': 0, 'dns_misses': 0}
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        stats = self.connection_stats
+
+        def counter(key):
+            async def increment(session, context, params):
+                stats[key] += 1
+            return increment
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(counter('created'))
+        trace.on_connection_reuseconn.append(counter('reused'))
+        trace.on_dns_cache_hit.append(counter('dns_hits'))
+        trace.on_dns_cache_miss.append(counter('dns_misses'))
+        return trace
 
     async def __aenter__(self):
-        headers = {'User-Agent': self.settings.site.user_agent}
-        timeout = aiohttp.ClientTimeout(total=30)
-        self.session = aiohttp.ClientSession(timeout=timeout, headers=headers)
+        site = self.settings.site
+        headers = {'User-Agent': site.user_agent}
+        # Один пул соединений на страницы и файлы: keep-alive, кэш DNS, лимит на хост
+        connector = aiohttp.TCPConnector(
+            limit=site.connection_limit,
+            limit_per_host=site.connection_limit_per_host,
+            ttl_dns_cache=site.dns_cache_ttl,
+            keepalive_timeout=site.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(total=site.page_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers,
+                                             trace_configs=[self._trace_config()])
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if self.session:
             await self.session.close()
+        stats = self.connection_stats
+        total = stats['created'] + stats['reused']
+        reuse = stats['reused'] / total * 100 if total else 0
+        logger.info(
+            f"HTTP connections: {stats['created']} opened, {stats['reused']} reused ({reuse:.1f}%), "
+            f"DNS cache {stats['dns_hits']} hits / {stats['dns_misses']} misses"
+        )
+        if self.cache:
+            self.cache.report()
+            self.cache.close()
+
+    async def fetch(self, url: str) -> Page:
+        """Страница с повторами при временных ошибках; если не вышло — FetchError."""
+        attempt = 0
+        while True:
+            try:
+                return await self._fetch_once(url)
+            except Exception as e:
+                retryable, retry_after = self.classify(e)
+                if not retryable:
+                    raise FetchError(url, str(e) or type(e).__name__, False) from e
+                if attempt >= self.settings.site.max_retries:
+                    raise FetchError(url, f"gave up after {attempt + 1} attempts: {e or type(e).__name__}",
+                                     True) from e
+                delay = self.retry_delay(attempt, retry_after)
+                metrics.inc('retries', stage='fetch')
+                logger.warning(f"Fetching {url} failed ({e or type(e).__name__}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def classify(self, error: Exception) -> Tuple[bool, Optional[float]]:
+        """(стоит ли повторять, Retry-After в секундах). Заодно сообщает лимитеру о перегрузке."""
+        if isinstance(error, aiohttp.ClientResponseError):
+            if error.status in THROTTLE_STATUSES:
+                metrics.inc('throttled')
+                retry_after = retry_after_seconds(error.headers.get('Retry-After') if error.headers else None)
+                self.limiter.on_throttle(retry_after)
+                return True, retry_after
+            return error.status in RETRYABLE_STATUSES, None
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+            return True, None
+        return False, None
+
+    def retry_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Экспоненциальная задержка с полным джиттером, но не меньше Retry-After."""
+        site = self.settings.site
+        delay = random.uniform(0, min(site.retry_backoff_max, site.retry_backoff * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def _fetch_once(self, url: str) -> Page:
+        cached = self.cache.get(url) if self.cache else None
+        page = await self._get(url, cached)
+        if page is None:
+            # 304, но тело пропало из кэша — запрашиваем заново без условий
+            page = await self._get(url, None)
+        return page
+
+    async def _get(self, url: str, cached) -> Optional[Page]:
+        headers = {}
+        if cached:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        await self.limiter.acquire()
+        started = time.monotonic()
+        with metrics.span('fetch', url):
+            async with self.session.get(url, headers=headers) as response:
+                return await self._read(url, cached, response, started)
+
+    async def _read(self, url: str, cached, response: aiohttp.ClientResponse, started: float) -> Optional[Page]:
+        metrics.inc('responses', status=response.status)
+        if response.status < 400:
+            self.limiter.on_response(time.monotonic() - started)
+        if cached and response.status == 304:
+            content = self.cache.read(url)
+            if content is None:
+                return None
+            self.cache.stats['not_modified'] += 1
+            metrics.inc('pages')
+            # Записи кэша без кодировки остались от старых версий — тогда страницы читались как UTF-8
+            return Page(url, content, cached.encoding or 'utf-8', True, cached.etag, cached.last_modified)
+        response.raise_for_status()
+        content = await response.read()
+        metrics.inc('pages')
+        metrics.inc('bytes', len(content), kind='page')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        unchanged = False
+        if self.cache:
+            if cached is None:
+                self.cache.stats['miss'] += 1
+            elif cached.sha256 == ResponseCache.content_hash(content):
+                self.cache.stats['unchanged'] += 1
+                unchanged = True
+            else:
+                self.cache.stats['changed'] += 1
+        # Кодировка всегда явная, как у response.text(): без charset в заголовке aiohttp берёт UTF-8,
+        # иначе lxml угадал бы Latin-1 и испортил кириллицу в именах товаров
+        return Page(url, content, response.get_encoding(), unchanged, etag, last_modified)
+
+    @asynccontextmanager
+    async def stream(self, url: str) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET для скачивания файла через общий пул, с таймаутом для больших файлов.
+        Повторы — на стороне вызывающего: см. classify и retry_delay."""
+        async with self.session.get(url, timeout=self.file_timeout) as response:
+            response.raise_for_status()
+            yield response
 
-    async def fetch(self, url: str) -> str:
-        await asyncio.sleep(self.settings.site.delay_between_requests)
-        try:
-            async with self.session.get(url) as response:
-                response.raise_for_status()
-                return await response.text()
-        except Exception as e:
-            logger.error(f"Error fetching {url}: {e}")
-            return None
-
-    def parse_links(self, html: str, selector: str) -> list:
-        if not html:
-            return []
-        soup = BeautifulSoup(html, 'lxml')
-        links = soup.select(selector)
-        return [link.get('href') for link in links if link.get('href')]
+    def remember(self, page: Page):
+        """Кладёт страницу в кэш — вызывать после того, как результат её разбора сохранён."""
+        if self.cache and not page.unchanged:
+            self.cache.put(page.url, page.content, page.etag, page.last_modified, page.encoding)
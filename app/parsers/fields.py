@@ -0,0 +1,109 @@
+# app/parsers/fields.py
+"""Извлечение типизированных полей товара из сохранённого body_html по правилам extraction.fields.
+
+Правила компилируются один раз на процесс: CSS → XPath через compile_selector, регулярные
+выражения — re.compile. Функции уровня модуля выполняются в пуле процессов (см. app/extract.py).
+"""
+import hashlib
+import json
+import re
+from datetime import date, datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from app.parsers.document import Document, compile_selector
+from app.storage.codec import body_hash, decode_body, set_dictionary_dir
+
+TRUE_VALUES = {'да', 'есть', 'yes', 'true', '1', '+'}
+
+_SPACES = re.compile(r'\s+')
+
+
+def _number(value: str) -> str:
+    # «1 250,5» → «1250.5»: пробелы-разделители разрядов и десятичная запятая
+    return _SPACES.sub('', value).replace(',', '.')
+
+
+CONVERTERS: Dict[str, Callable[[str, 'CompiledRule'], object]] = {
+    'str': lambda value, rule: value,
+    'int': lambda value, rule: int(_number(value)),
+    'float': lambda value, rule: float(_number(value)),
+    'date': lambda value, rule: datetime.strptime(value, rule.date_format).date(),
+    'bool': lambda value, rule: value.lower() in TRUE_VALUES,
+}
+
+
+class CompiledRule(NamedTuple):
+    name: str
+    selector: str
+    attribute: Optional[str]
+    regex: Optional['re.Pattern']
+    convert: Callable[[str, 'CompiledRule'], object]
+    date_format: str
+
+
+class ExtractedRow(NamedTuple):
+    rawdata_id: int
+    product_name: str
+    body_sha256: str
+    values: Dict[str, object]
+    errors: List[str]  # поля, значение которых не удалось привести к типу
+
+
+def rules_hash(fields: dict) -> str:
+    """Хэш правил в виде словаря из конфига: меняется при любой правке селектора, regex или типа."""
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def compile_rules(fields: dict) -> List[CompiledRule]:
+    rules = []
+    for name, rule in fields.items():
+        if rule['type'] not in CONVERTERS:
+            raise ValueError(f"Field {name}: unknown type {rule['type']!r}, expected one of {', '.join(CONVERTERS)}")
+        compile_selector(rule['selector'])
+        regex = re.compile(rule['regex']) if rule.get('regex') else None
+        rules.append(CompiledRule(name, rule['selector'], rule.get('attribute'), regex, CONVERTERS[rule['type']],
+                                  rule.get('date_format') or '%d.%m.%Y'))
+    return rules
+
+
+def extract_fields(doc: Document, rules: List[CompiledRule]) -> Tuple[Dict[str, object], List[str]]:
+    values, errors = {}, []
+    for rule in rules:
+        raw = doc.first(rule.selector, rule.attribute)
+        if raw is not None:
+            raw = _SPACES.sub(' ', raw).strip()
+        if raw and rule.regex is not None:
+            match = rule.regex.search(raw)
+            raw = (match.group(1) if match.re.groups else match.group(0)) if match else None
+        if not raw:
+            values[rule.name] = None
+            continue
+        try:
+            values[rule.name] = rule.convert(raw, rule)
+        except ValueError:
+            values[rule.name] = None
+            errors.append(rule.name)
+    return values, errors
+
+
+# Состояние процесса пула: правила компилируются в initializer, а не на каждую пачку
+_rules: List[CompiledRule] = []
+
+
+def init_worker(fields: dict, dictionary_dir: str):
+    global _rules
+    _rules = compile_rules(fields)
+    set_dictionary_dir(dictionary_dir)
+
+
+def extract_batch(rows: List[tuple]) -> List[ExtractedRow]:
+    """rows — (rawdata id, product_name, body_html, body_zip, body_codec); распаковка тоже здесь, в пуле."""
+    result = []
+    for rawdata_id, product_name, body_html, body_zip, body_codec in rows:
+        html = decode_body(body_zip, body_codec) if body_zip is not None else body_html
+        values, errors = extract_fields(Document(f'<html>{html}</html>'), _rules)
+        result.append(ExtractedRow(rawdata_id, product_name, body_hash(html), values, errors))
+    return result
+
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
@@ -0,0 +1,205 @@
+# app/parsers/pipeline.py
+import asyncio
+from typing import Optional
+from loguru import logger
+from app.limits import RunBudget
+from app.metrics import metrics
+from app.parsers.discovery import Discovery
+from app.parsers.fetcher import Fetcher, FetchError
+from app.parsers.processor import Processor
+from app.parsers.scheduler import Scheduler
+from app.storage.postgres import PostgresStorage
+from app.utils import absolute_url
+
+# Как часто, пока идёт обход каталога, перечитывать из БД найденные им коды, секунд
+DISCOVERY_POLL = 1.0
+
+
+class Pipeline:
+    """Стадии коды → имена → тело/файлы, связанные ограниченными очередями.
+
+    Имена, найденные на странице кода, сразу уходят в стадию имён; когда её очередь
+    заполнена, воркеры стадии кодов ждут, а за ними ждёт и чтение pending-строк из БД.
+    """
+
+    def __init__(self, settings, fetcher: Fetcher, processor: Processor, postgres: PostgresStorage,
+                 budget: RunBudget, gui: 'ParserGUI' = None):
+        self.settings = settings
+        self.fetcher = fetcher
+        self.processor = processor
+        self.postgres = postgres
+        self.budget = budget
+        self.gui = gui
+
+        workers = settings.site.max_workers
+        queue_size = settings.site.queue_size
+        self.codes = Scheduler(self.process_code, workers, queue_size, name='codes')
+        self.names = Scheduler(self.process_name, workers, queue_size, name='names')
+        self.discovery = Discovery(settings, fetcher, processor, postgres, budget)
+
+        self.codes_processed = 0
+        self.names_processed = 0
+        self.files_downloaded = 0
+        self.errors = 0
+
+    @property
+    def stopped(self) -> bool:
+        return self.codes.stopped or self.names.stopped
+
+    def stop(self):
+        self.discovery.stop()
+        self.codes.stop()
+        self.names.stop()
+
+    async def run(self) -> bool:
+        """Возвращает False, если прогон был остановлен до конца."""
+        self.codes.start()
+        self.names.start()
+        metrics.gauge('queue_depth', self.codes.queue.qsize, queue='codes')
+        metrics.gauge('queue_depth', self.names.queue.qsize, queue='names')
+        watcher = asyncio.create_task(self._watch_stop())
+        try:
+            # Новые имена приходят от стадии кодов уже арендованными этим процессом,
+            # а из очереди в БД берутся только свободные: с прошлых запусков или от упавших воркеров
+            await asyncio.gather(self._codes_stage(), self._feed_names())
+            await self.names.join()
+        finally:
+            watcher.cancel()
+            metrics.remove_gauges('queue_depth')
+            self._report()
+        return not self.stopped
+
+    async def _codes_stage(self):
+        # Шаг 1: Обход каталога — параллельно с обработкой кодов, которые он уже сохранил
+        discovery = await self._start_discovery()
+
+        # Шаг 2: Обработать все незавершенные коды
+        while not self.codes.stopped:
+            async for code_obj in self.postgres.iter_pending_codes(self.settings.site.queue_size):
+                if not await self.codes.submit(code_obj):
+                    break
+            if discovery is None:
+                break
+            # Пока обход идёт, новые коды появляются в БД — перечитываем очередь после каждого прохода
+            await self.codes.queue.join()
+            done, _ = await asyncio.wait([discovery], timeout=DISCOVERY_POLL)
+            if done:
+                discovery = None
+        if discovery is not None:
+            await discovery
+        await self.codes.join()
+
+    async def _start_discovery(self) -> Optional[asyncio.Task]:
+        if not self.settings.discovery.enabled:
+            return None
+        interval = self.settings.queue.discovery_interval
+        # Пропускаем обход только при продолжении прерванного прогона: по одному возрасту отметки
+        # ежедневный запуск, начавшийся чуть раньше чем через сутки, пропускал бы каталог через раз
+        age = None
+        if interval and await self.postgres.has_pending_codes():
+            age = await self.postgres.checkpoint_age(self.discovery.checkpoint)
+        if age is not None and age < interval:
+            logger.info(f"Catalog was crawled {age / 60:.0f} min ago and codes are still queued, resuming "
+                        f"from the queue (queue.discovery_interval)")
+            return None
+        return asyncio.create_task(self.discovery.run())
+
+    async def _feed_names(self):
+        # Шаг 3: Обработать все незавершенные имена
+        async for name_obj in self.postgres.iter_pending_names(self.settings.site.queue_size):
+            if not await self.names.submit(name_obj):
+                break
+
+    async def _watch_stop(self):
+        # Кнопка Stop нажимается в потоке GUI — здесь только опрашиваем флаг.
+        # Заодно ловим лимит по времени, даже если все воркеры ждут ответа сервера,
+        # и отдаём в GUI снимок статистики — не чаще раза за тик, а не на каждую страницу.
+        while not self.stopped:
+            if self.gui and not self.gui.is_running:
+                logger.info("Parser stopped by user.")
+                self.stop()
+                return
+            self._check_budget()
+            self._report()
+            await asyncio.sleep(0.2)
+
+    def _check_budget(self):
+        reason = self.budget.exceeded()
+        if reason and not self.stopped:
+            logger.info(f"Run limit reached: {reason}. Stopping.")
+            self.stop()
+            if self.gui:
+                self.gui.stop_parser()  # Останавливаем GUI
+
+    def _report(self):
+        if self.gui:
+            self.gui.update_stats(codes=self.codes_processed, names=self.names_processed,
+                                  files=self.files_downloaded, errors=self.errors,
+                                  pages=self.budget.pages, bytes=self.budget.bytes,
+                                  codes_queue=self.codes.queue.qsize(), names_queue=self.names.queue.qsize())
+
+    def _failed_status(self, row, error: Exception, retry_status: str = 'retry') -> str:
+        # Временные сбои сети/сервера — в retry_status, пока не исчерпан лимит попыток
+        if isinstance(error, FetchError) and error.retryable \
+                and row.attempts + 1 < self.settings.site.max_page_attempts:
+            return retry_status
+        return 'error'
+
+    async def process_code(self, code_obj):
+        try:
+            page = await self.fetcher.fetch(absolute_url(self.settings.site.base_url, code_obj.url))
+            self.budget.add_page(len(page.content))
+            # Разбираем и неизменившуюся страницу: кэш HTTP не знает, есть ли её имена в этой БД
+            # (сброс БД, повторно поставленные в очередь строки, свой кэш на каждом узле).
+            # Уже сохранённые имена отсекает ON CONFLICT
+            names = await self.processor.extract_names_from_page(page, code_obj.code)
+            # Имена и статус fetched — одной транзакцией: после сбоя страница не запрашивается снова
+            new_names = await self.postgres.complete_code(code_obj.id,
+                                                          ((code, name, url) for name, url, code in names))
+            if new_names is None:
+                logger.warning(f"Lease on code {code_obj.code} was taken over by another worker, result dropped")
+                return
+            self.fetcher.remember(page)
+            for name_obj in new_names:
+                await self.names.submit(name_obj)
+            self.codes_processed += 1
+            self._check_budget()
+        except Exception as e:
+            logger.error(f"Error processing code {code_obj.code}: {e}")
+            metrics.inc('errors', stage='code')
+            await self.postgres.update_code_status(code_obj.id, self._failed_status(code_obj, e))
+            self.errors += 1
+
+    async def process_name(self, name_obj):
+        parsed = name_obj.status == 'parsed'
+        try:
+            if parsed:
+                # Страница разобрана в прошлый раз — осталось докачать файлы, без повторного запроса
+                file_urls = await self.postgres.pending_files(name_obj.name)
+            else:
+                page = await self.fetcher.fetch(absolute_url(self.settings.site.base_url, name_obj.url))
+                self.budget.add_page(len(page.content))
+                file_urls = []
+                # Неизменившуюся страницу пропускаем, только если её rawdata действительно есть в БД
+                if not page.unchanged or not await self.postgres.has_rawdata(name_obj.name):
+                    product = await self.processor.parse_product_page(page)
+                    file_urls = self.processor.file_urls(product)
+                    await self.processor.save_product(product, name_obj.name, file_urls)
+                    # parsed фиксируется в одной пачке со своими rawdata и images
+                    await self.postgres.update_name_status(name_obj.id, 'parsed')
+                    parsed = True
+                # В кэш — только после коммита rawdata, иначе после сбоя страница сочтётся обработанной
+                self.postgres.after_flush(lambda: self.fetcher.remember(page))
+            if not await self.processor.download_and_save_files(file_urls, name_obj.name):
+                # Лимит прогона: имя остаётся parsed и продолжится со скачивания в следующий раз
+                return
+            await self.postgres.update_name_status(name_obj.id, 'stored')
+            self.names_processed += 1
+            self.files_downloaded += 1
+            self._check_budget()
+        except Exception as e:
+            logger.error(f"Error processing name {name_obj.name}: {e}")
+            metrics.inc('errors', stage='name')
+            status = self._failed_status(name_obj, e, 'parsed' if parsed else 'retry')
+            await self.postgres.update_name_status(name_obj.id, status, failed=True)
+            self.errors += 1
@@ -1,90 +1,202 @@
 # app/parsers/processor.py
-from bs4 import BeautifulSoup
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
+from app.limits import RunBudget
+from app.metrics import metrics
+from app.parsers.document import (
+    ListingPage, ProductPage, compile_selector, extract_links, extract_listing, extract_product
+)
+from app.parsers.fetcher import Fetcher, FetchError, Page
 from app.storage.postgres import PostgresStorage
-from app.storage.mongo import MongoStorage
-from app.models.mongo import FileMetadata
+from app.storage.mongo import MongoStorage, UploadInProgress
+from app.storage.codec import BodyCodec, body_hash
+from app.models.mongo import FileMetadata, StoredFile
+from typing import List, Optional
+from app.utils import absolute_url
 import os
 import re
-from sqlalchemy import func
-from app.models.postgres import Rawdata
 
 
 class Processor:
-    def __init__(self, postgres_storage: PostgresStorage, mongo_storage: MongoStorage, settings):
+    def __init__(self, postgres_storage: PostgresStorage, mongo_storage: MongoStorage, settings, fetcher: Fetcher,
+                 budget: RunBudget):
         self.postgres = postgres_storage
         self.mongo = mongo_storage
         self.settings = settings
+        self.fetcher = fetcher
+        self.budget = budget
+        # Селекторы из TagsConfig компилируются в XPath один раз на процесс
+        tags = settings.tags
+        for css in (tags.codes_page.links_selector, tags.codes_page.category_selector,
+                    tags.codes_page.pagination_selector, tags.names_page.links_selector, tags.file_link_selector):
+            if css:
+                compile_selector(css)
+        for css in settings.rawdata.strip_selectors:
+            compile_selector(css)
+        # None — body_html пишется как есть, без сжатия
+        self.codec = BodyCodec.from_config(settings.rawdata)
+        # Разбор HTML в отдельных процессах, чтобы не блокировать event loop; 0 — в текущем потоке
+        workers = settings.site.parse_workers
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        # Один и тот же файл, запрошенный несколькими воркерами сразу, скачивается один раз
+        self._downloads = {}
     
-    def extract_codes_from_page(self, html: str) -> list:
-        soup = BeautifulSoup(html, 'lxml')
-        links = soup.select(self.settings.tags.links_selector)
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+        if self.mongo is None:
+            return
+        stats = self.mongo.stats
+        logger.info(
+            f"Files: {stats['stored']} stored, {stats['url_hits']} reused by URL, "
+            f"{stats.get('recovered', 0)} recovered after interrupted runs, "
+            f"{stats['content_hits']} deduplicated by content, {stats['bytes_saved'] / 1024 / 1024:.1f} MB saved"
+        )
+    
+    async def _parse(self, page: Page, func, *args):
+        # В пуле процессов замер включает и ожидание свободного процесса
+        with metrics.span('parse', page.url):
+            if self.executor is None:
+                return func(page.content, page.encoding, *args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, page.content, page.encoding, *args)
+    
+    def codes_from_links(self, hrefs) -> list:
         codes = []
-        for link in links:
-            href = link.get('href')
-            if href:
-                match = re.search(r'/product/(\d+)/', href)
-                if match:
-                    code = match.group(1)
-                    if code not in self.settings.blacklist.codes:
-                        codes.append((code, href))
+        for href in hrefs:
+            match = re.search(r'/product/(\d+)/', href)
+            if match:
+                code = match.group(1)
+                if code not in self.settings.blacklist.codes:
+                    codes.append((code, href))
         return codes
     
-    def extract_names_from_page(self, html: str, product_code: str) -> list:
-        soup = BeautifulSoup(html, 'lxml')
-        links = soup.select(self.settings.tags.links_selector)
+    async def parse_listing_page(self, page: Page) -> ListingPage:
+        """Ссылки на коды, категории и страницы пагинации одним разбором страницы."""
+        tags = self.settings.tags.codes_page
+        return await self._parse(page, extract_listing, tags.links_selector, tags.category_selector,
+                                 tags.pagination_selector)
+    
+    async def extract_names_from_page(self, page: Page, product_code: str) -> list:
+        links = await self._parse(page, extract_links, self.settings.tags.names_page.links_selector)
         names = []
-        for link in links:
-            href = link.get('href')
-            title = link.get_text(strip = True)
-            if href and title:
+        for href, title in links:
+            if title:
                 names.append((title, href, product_code))
         return names
     
-    async def extract_and_save_body_html(self, html: str, product_name: str):
-        soup = BeautifulSoup(html, 'lxml')
-        body = soup.find('body')
-        if body:
-            body_html = str(body)
-            await self.postgres.save_rawdata(product_name, body_html)
+    async def parse_product_page(self, page: Page) -> ProductPage:
+        return await self._parse(page, extract_product, self.settings.tags.file_link_selector,
+                                 tuple(self.settings.rawdata.strip_selectors))
+    
+    async def save_body_html(self, product: ProductPage, product_name: str):
+        if product.body_html:
+            body_sha256 = body_hash(product.body_html)
+            if self.codec is None:
+                await self.postgres.save_rawdata(product_name, product.body_html, body_sha256=body_sha256)
+            else:
+                body_zip, body_codec = self.codec.encode(product.body_html)
+                await self.postgres.save_rawdata(product_name, body_zip=body_zip, body_codec=body_codec,
+                                                 body_sha256=body_sha256)
+            self.budget.add_rawdata()
+    
+    def file_urls(self, product: ProductPage) -> List[str]:
+        """Абсолютные ссылки на файлы товара, которые нужно скачать, без повторов."""
+        urls = {}
+        for href in product.file_urls:
+            ext = os.path.splitext(href)[1].lower()
+            if ext in self.settings.blacklist.file_extensions:
+                continue
+            urls.setdefault(absolute_url(self.settings.site.base_url, href), None)
+        return list(urls)
+    
+    async def save_product(self, product: ProductPage, product_name: str, file_urls: List[str]):
+        """Тело страницы и список её файлов: после сбоя обработка продолжится со скачивания."""
+        await self.save_body_html(product, product_name)
+        await self.postgres.save_pending_images(product_name, file_urls)
     
-    async def download_and_save_files(self, html: str, product_name: str):
-        soup = BeautifulSoup(html, 'lxml')
-        file_links = soup.select(self.settings.tags.file_link_selector)
+    async def download_and_save_files(self, file_urls: List[str], product_name: str) -> bool:
+        """False — файлы не скачивались из-за лимита прогона. Если часть файлов не удалось
+        получить из-за временных ошибок, остальные сохраняются и выбрасывается FetchError."""
+        if not file_urls:
+            return True
         
-        # ✅ Проверяем количество записей в Rawdata перед скачиванием файлов
-        async with self.postgres.session as session:
-            rawdata_count = await session.execute(
-                    func.count(Rawdata.id).select()
-                    )
-            count = rawdata_count.scalar()
-            if count >= 5:
-                logger.info(f"Rawdata limit reached ({count}), skipping file downloads.")
-                return
+        # ✅ Проверяем лимиты прогона перед скачиванием файлов
+        reason = self.budget.exceeded()
+        if reason:
+            logger.info(f"Run limit reached ({reason}), skipping file downloads.")
+            return False
         
-        for link in file_links:
-            href = link.get('href') or link.get('src')
-            if href:
-                ext = os.path.splitext(href)[1].lower()
-                if ext in self.settings.blacklist.file_extensions:
-                    continue
-                await self.download_and_store_file(href, product_name)
+        failed = 0
+        for file_url in file_urls:
+            try:
+                await self.download_and_store_file(file_url, product_name)
+            except FetchError:
+                failed += 1
+        if failed:
+            raise FetchError(product_name, f"{failed} of {len(file_urls)} files failed", True)
+        return True
     
     async def download_and_store_file(self, file_url: str, product_name: str):
-        from aiohttp import ClientSession
-        timeout = aiohttp.ClientTimeout(total = 30)
-        async with ClientSession(timeout = timeout) as session:
+        stored = await self.mongo.find_by_url(file_url)
+        if stored is None:
+            task = self._downloads.get(file_url)
+            if task is None:
+                task = asyncio.ensure_future(self._download_file(file_url, product_name))
+                self._downloads[file_url] = task
+                task.add_done_callback(lambda _: self._downloads.pop(file_url, None))
+            stored = await asyncio.shield(task)
+        if stored is not None:
+            await self.postgres.save_image(product_name, stored.file_id, file_url)
+    
+    async def _download_file(self, file_url: str, product_name: str) -> Optional[StoredFile]:
+        """None — файл пропущен (слишком большой или постоянная ошибка); FetchError —
+        временные ошибки не прошли за max_retries попыток."""
+        attempt = 0
+        while True:
             try:
-                async with session.get(file_url) as resp:
-                    resp.raise_for_status()
-                    data = await resp.read()
-                    filename = file_url.split('/')[-1]
-                    metadata = FileMetadata(
-                            original_url = file_url, product_name = product_name, filename = filename,
-                            content_type = resp.content_type, size = len(data)
-                            )
-                    file_id = await self.mongo.save_file(data, metadata)
-                    await self.postgres.save_image(product_name, file_id, file_url)
-                    logger.info(f"File {filename} saved to MongoDB with ID {file_id}")
+                if attempt:
+                    # Файл мог докачать другой процесс, пока мы ждали
+                    stored = await self.mongo.find_by_url(file_url)
+                    if stored is not None:
+                        return stored
+                return await self._stream_file(file_url, product_name)
             except Exception as e:
-                logger.error(f"Failed to download or save file {file_url}: {e}")
\ No newline at end of file
+                if isinstance(e, UploadInProgress):
+                    retryable, retry_after = True, None
+                else:
+                    retryable, retry_after = self.fetcher.classify(e)
+                if not retryable or attempt >= self.settings.site.max_retries:
+                    logger.error(f"Failed to download or save file {file_url}: {e}")
+                    metrics.inc('errors', stage='file')
+                    if retryable:
+                        raise FetchError(file_url, str(e) or type(e).__name__, True) from e
+                    return None
+                metrics.inc('retries', stage='file')
+                await asyncio.sleep(self.fetcher.retry_delay(attempt, retry_after))
+                attempt += 1
+    
+    async def _stream_file(self, file_url: str, product_name: str) -> Optional[StoredFile]:
+        site = self.settings.site
+        max_size = site.max_file_size_mb * 1024 * 1024
+        async with self.fetcher.stream(file_url) as resp:
+            if resp.content_length and resp.content_length > max_size:
+                logger.warning(f"File {file_url} is {resp.content_length} bytes, over the limit, skipped")
+                return None
+            filename = file_url.split('/')[-1]
+            metadata = FileMetadata(
+                    original_url = file_url, product_name = product_name, filename = filename,
+                    content_type = resp.content_type
+                    )
+            # Файл идёт в GridFS кусками, не собираясь целиком в памяти
+            stored = await self.mongo.save_stream(
+                    resp.content.iter_chunked(site.download_chunk_size), metadata, max_size
+                    )
+            if stored is None:
+                logger.warning(f"File {file_url} exceeded {site.max_file_size_mb} MB, download aborted")
+                return None
+            logger.info(f"File {filename} ({stored.size} bytes) saved to MongoDB with ID {stored.file_id}")
+            self.budget.add_bytes(stored.size)
+            metrics.inc('bytes', stored.size, kind='file')
+            return stored
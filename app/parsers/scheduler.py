@@ -0,0 +1,143 @@
+# app/parsers/scheduler.py
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+from loguru import logger
+
+
+class RateLimiter:
+    """Глобальный token bucket: не больше `rate` запросов в секунду на все воркеры."""
+
+    def __init__(self, rate: Optional[float], burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Ни одного запроса в ближайшие `seconds` секунд (Retry-After)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def on_response(self, latency: float):
+        pass
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        if retry_after:
+            self.pause(retry_after)
+
+    async def acquire(self):
+        if not self.rate and self.paused_until <= time.monotonic():
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if not self.rate:
+                    return
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Token bucket, скорость которого подстраивается под ответы сервера (AIMD).
+
+    Пока сервер отвечает быстро, скорость растёт на `step` за каждый ответ до `max_rate`.
+    На 429/503 и при задержке больше `latency_factor` × лучшей наблюдавшейся скорость
+    делится пополам, но не чаще раза за `cooldown` секунд и не ниже `min_rate`.
+    """
+
+    def __init__(self, rate: float, min_rate: float, max_rate: float, latency_factor: float = 2.0,
+                 cooldown: float = 1.0):
+        super().__init__(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = max(rate * 0.05, 0.01)
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.latency = None
+        self.best_latency = None
+        self.decreased_at = 0.0
+
+    def on_response(self, latency: float):
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+        self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+        if self.latency > self.best_latency * self.latency_factor:
+            self._decrease()
+        else:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        super().on_throttle(retry_after)
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.decreased_at < self.cooldown:
+            return
+        self.decreased_at = now
+        old_rate = self.rate
+        self.rate = max(self.min_rate, self.rate / 2)
+        if self.rate < old_rate:
+            logger.info(f"Server is slowing down, request rate {old_rate:.2f} -> {self.rate:.2f}/s")
+
+
+class Scheduler:
+    """Очередь задач, которую разбирают `workers` параллельных воркеров."""
+
+    def __init__(self, handler: Callable[[object], Awaitable[None]], workers: int, maxsize: int = 0,
+                 name: str = 'scheduler'):
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.name = name
+        self.queue = asyncio.Queue(maxsize)
+        self.stopped = False
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def submit(self, job) -> bool:
+        if self.stopped:
+            return False
+        await self.queue.put(job)
+        return True
+
+    def stop(self):
+        """Останавливает приём задач и выбрасывает всё, что ещё ждёт в очереди.
+        Задачи, которые уже выполняются, доделываются до конца."""
+        if self.stopped:
+            return
+        self.stopped = True
+        dropped = 0
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            dropped += 1
+        logger.info(f"{self.name}: stopped, {dropped} queued jobs dropped")
+
+    async def join(self):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if not self.stopped:
+                    await self.handler(job)
+            except Exception as e:
+                logger.error(f"{self.name}: unhandled error in job {job!r}: {e}")
+            finally:
+                self.queue.task_done()
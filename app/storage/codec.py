@@ -0,0 +1,96 @@
+# app/storage/codec.py
+import hashlib
+import os
+import zlib
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # без zstandard пишем zlib, а zstd-строки прочитать нельзя
+    zstandard = None
+
+# Имя кодека хранится в rawdata.body_codec рядом с данными:
+#   zlib, zstd, zstd:<dict_id> — zstd с обученным словарём <dictionary_dir>/<dict_id>.zdict
+_dictionary_dir = 'dicts'
+
+
+def set_dictionary_dir(path: str):
+    global _dictionary_dir
+    _dictionary_dir = path
+    _load_dictionary.cache_clear()
+
+
+def dictionary_path(dict_id: int, directory: Optional[str] = None) -> str:
+    return os.path.join(directory or _dictionary_dir, f'{dict_id}.zdict')
+
+
+@lru_cache(maxsize=None)
+def _load_dictionary(dict_id: int) -> 'zstandard.ZstdCompressionDict':
+    with open(dictionary_path(dict_id), 'rb') as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise RuntimeError("zstd-compressed rawdata requires the 'zstandard' package")
+
+
+def decode_body(data: bytes, codec: str) -> str:
+    if codec == 'zlib':
+        return zlib.decompress(data).decode('utf-8')
+    _require_zstd()
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    if codec.startswith('zstd:'):
+        dictionary = _load_dictionary(int(codec.split(':', 1)[1]))
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data).decode('utf-8')
+    raise ValueError(f"Unknown rawdata codec {codec!r}")
+
+
+def body_hash(body_html: str) -> str:
+    """sha256 несжатого тела — по нему стадия извлечения полей узнаёт изменившиеся строки."""
+    return hashlib.sha256(body_html.encode('utf-8')).hexdigest()
+
+
+def train_dictionary(samples: List[str], size: int, directory: str) -> int:
+    """Обучает zstd-словарь на образцах body_html, сохраняет его и возвращает dict_id."""
+    _require_zstd()
+    dictionary = zstandard.train_dictionary(size, [s.encode('utf-8') for s in samples])
+    os.makedirs(directory, exist_ok=True)
+    with open(dictionary_path(dictionary.dict_id(), directory), 'wb') as f:
+        f.write(dictionary.as_bytes())
+    return dictionary.dict_id()
+
+
+class BodyCodec:
+    """Сжатие body_html для компактного хранения в rawdata.body_zip."""
+
+    def __init__(self, method: str = 'zstd', level: int = 3, dictionary_id: Optional[int] = None):
+        if method == 'zstd' and zstandard is None:
+            method = 'zlib'
+            dictionary_id = None
+        self.method = method
+        self.level = level
+        if method == 'zstd':
+            dictionary = _load_dictionary(dictionary_id) if dictionary_id else None
+            self.name = f'zstd:{dictionary_id}' if dictionary else 'zstd'
+            # Компрессор не потокобезопасен — кодек используется только из event loop
+            self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        elif method == 'zlib':
+            self.name = 'zlib'
+        else:
+            raise ValueError(f"Unknown rawdata compression method {method!r}")
+
+    @classmethod
+    def from_config(cls, config) -> Optional['BodyCodec']:
+        set_dictionary_dir(config.dictionary_dir)
+        if not config.compress:
+            return None
+        return cls(config.method, config.level, config.dictionary_id)
+
+    def encode(self, body_html: str) -> Tuple[bytes, str]:
+        data = body_html.encode('utf-8')
+        if self.method == 'zlib':
+            return zlib.compress(data, self.level), self.name
+        return self._compressor.compress(data), self.name
@@ -0,0 +1,106 @@
+# app/storage/compact.py
+"""Перевод уже сохранённых строк rawdata в сжатый вид.
+
+Строки с несжатым body_html обходятся пачками по id: из тела вырезаются блоки
+rawdata.strip_selectors, оно сжимается в body_zip, а body_html обнуляется.
+Каждая пачка — отдельная транзакция, поэтому прерванный запуск можно просто повторить.
+
+    python -m app compact --batch-size 500
+    python -m app compact --train --dict-size 112640 --samples 2000
+"""
+import argparse
+import asyncio
+import time
+from loguru import logger
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app.config import RawdataConfig, add_config_argument, get_settings
+from app.models.postgres import Rawdata, init_db
+from app.parsers.document import Document
+from app.storage.codec import BodyCodec, body_hash, set_dictionary_dir, train_dictionary
+from typing import Optional, Sequence
+
+
+def strip_body(body_html: str, strip: Sequence[str]) -> str:
+    if not strip:
+        return body_html
+    return Document(f"<html>{body_html}</html>").body_html(strip) or body_html
+
+
+async def _uncompressed_batch(session: AsyncSession, after_id: int, limit: int) -> list:
+    result = await session.execute(
+        select(Rawdata.id, Rawdata.body_html)
+        .where(Rawdata.id > after_id, Rawdata.body_zip.is_(None), Rawdata.body_html.isnot(None))
+        .order_by(Rawdata.id)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def train(engine, config: RawdataConfig, samples: int, dict_size: int) -> int:
+    async with AsyncSession(engine) as session:
+        rows = await _uncompressed_batch(session, 0, samples)
+    if not rows:
+        raise SystemExit("No uncompressed rawdata rows to train a dictionary on")
+    dict_id = train_dictionary([strip_body(body, config.strip_selectors) for _, body in rows], dict_size,
+                               config.dictionary_dir)
+    logger.info(f"Trained dictionary {dict_id} on {len(rows)} rows; set rawdata.dictionary_id: {dict_id} in config")
+    return dict_id
+
+
+async def compact(engine, config: RawdataConfig, batch_size: int, dictionary_id: Optional[int] = None):
+    codec = BodyCodec(config.method, config.level, dictionary_id or config.dictionary_id)
+    rows_done = bytes_before = bytes_after = 0
+    started = time.monotonic()
+    last_id = 0
+    while True:
+        async with AsyncSession(engine) as session, session.begin():
+            rows = await _uncompressed_batch(session, last_id, batch_size)
+            if not rows:
+                break
+            values = []
+            for row_id, body_html in rows:
+                stripped = strip_body(body_html, config.strip_selectors)
+                body_zip, body_codec = codec.encode(stripped)
+                values.append({'id': row_id, 'body_html': None, 'body_zip': body_zip, 'body_codec': body_codec,
+                               'body_sha256': body_hash(stripped)})
+                bytes_before += len(body_html.encode('utf-8'))
+                bytes_after += len(body_zip)
+            # UPDATE по первичному ключу одной пачкой (executemany)
+            await session.execute(update(Rawdata), values)
+        last_id = rows[-1][0]
+        rows_done += len(rows)
+        logger.info(f"Compacted {rows_done} rows, up to id {last_id}")
+    ratio = bytes_before / bytes_after if bytes_after else 0
+    logger.info(
+        f"Done in {time.monotonic() - started:.0f}s: {rows_done} rows, {bytes_before / 1024 / 1024:.1f} MB -> "
+        f"{bytes_after / 1024 / 1024:.1f} MB ({ratio:.1f}x, codec {codec.name})"
+    )
+
+
+async def run(args):
+    settings = get_settings(args.config)
+    config = settings.rawdata
+    set_dictionary_dir(config.dictionary_dir)
+    engine = create_async_engine(settings.database.postgres.url)
+    try:
+        # Обе стадии читают столбцы rawdata из миграций, а миграциям нужны все таблицы
+        await init_db(engine)
+        dictionary_id = await train(engine, config, args.samples, args.dict_size) if args.train else None
+        await compact(engine, config, args.batch_size, dictionary_id)
+    finally:
+        await engine.dispose()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Compress stored rawdata bodies in place")
+    add_config_argument(parser)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--train', action='store_true', help="train a zstd dictionary on stored rows first")
+    parser.add_argument('--samples', type=int, default=2000, help="rows to train the dictionary on")
+    parser.add_argument('--dict-size', type=int, default=112640, help="dictionary size in bytes")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
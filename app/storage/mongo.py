@@ -1,26 +1,157 @@
 # app/storage/mongo.py
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
-from app.models.mongo import FileMetadata
-import io
+from pymongo.errors import DuplicateKeyError
+from app.metrics import metrics
+from app.models.mongo import FileMetadata, StoredFile
+from typing import TYPE_CHECKING, AsyncIterator, BinaryIO, Dict, Iterable, Optional
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+import hashlib
+import time
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+
+class UploadInProgress(Exception):
+    """Этот URL прямо сейчас загружает в GridFS другой процесс — повторить позже."""
+
+
+def file_id_for_url(url: str) -> ObjectId:
+    """_id файла в GridFS определяется URL, поэтому повторная загрузка попадает в тот же файл."""
+    return ObjectId(hashlib.sha256(url.encode('utf-8')).digest()[:12])
 
 
 class MongoStorage:
-    def __init__(self, client: AsyncIOMotorClient, db_name: str, bucket_name: str):
+    """GridFS с дедупликацией: индекс URL → файл, чтобы не скачивать повторно,
+    и индекс sha256 → файл, чтобы одинаковое содержимое хранилось один раз.
+
+    Загрузка идемпотентна по URL: _id файла выводится из URL (file_id_for_url). Файл,
+    загруженный до сбоя, но не попавший в индексы, находится по этому _id и не качается
+    заново, а куски оборванной загрузки удаляются перед следующей попыткой.
+    """
+
+    def __init__(self, client: 'AsyncIOMotorClient', db_name: str, bucket_name: str, upload_timeout: float = 600):
         self.client = client
         self.db = client[db_name]
-        self.fs = AsyncIOMotorGridFSBucket(self.db, bucket_name=bucket_name)
+        self.fs = self._bucket(bucket_name)
+        self.files = self.db[f'{bucket_name}.files']
+        self.chunks = self.db[f'{bucket_name}.chunks']
+        self.url_index = self.db[f'{bucket_name}.urls']  # _id — оригинальный URL
+        self.hash_index = self.db[f'{bucket_name}.hashes']  # _id — sha256 содержимого
+        # Куски старше этого срока без записи в files точно брошены, а не пишутся прямо сейчас
+        self.upload_timeout = timedelta(seconds=upload_timeout)
+        self.stats = {'stored': 0, 'url_hits': 0, 'content_hits': 0, 'recovered': 0, 'bytes_saved': 0}
+
+    def _bucket(self, bucket_name: str):
+        # motor нужен только здесь: хранилище в памяти (app/bench) подменяет GridFS и обходится без него
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+        return AsyncIOMotorGridFSBucket(self.db, bucket_name=bucket_name)
+
+    async def find_by_url(self, url: str) -> Optional[StoredFile]:
+        doc = await self.url_index.find_one({'_id': url})
+        if not doc:
+            return await self._recover(url)
+        self.stats['url_hits'] += 1
+        self.stats['bytes_saved'] += doc['size']
+        return StoredFile(file_id=doc['file_id'], size=doc['size'], sha256=doc['sha256'])
+
+    async def _recover(self, url: str) -> Optional[StoredFile]:
+        """Файл, загрузка которого завершилась, но процесс упал до записи в индексы."""
+        doc = await self.files.find_one({'_id': file_id_for_url(url)}, projection={'length': 1, 'metadata': 1})
+        sha256 = doc and (doc.get('metadata') or {}).get('sha256')
+        if not sha256:
+            return None
+        stored = await self._deduplicate(StoredFile(file_id=str(doc['_id']), size=doc['length'], sha256=sha256))
+        await self._remember_url(url, stored)
+        self.stats['recovered'] += 1
+        return stored
+
+    async def _deduplicate(self, stored: StoredFile) -> StoredFile:
+        """Регистрирует содержимое в индексе хэшей; если такое уже есть — удаляет только
+        что загруженную копию и возвращает существующий файл."""
+        try:
+            await self.hash_index.insert_one({'_id': stored.sha256, 'file_id': stored.file_id, 'size': stored.size})
+            self.stats['stored'] += 1
+            return stored
+        except DuplicateKeyError:
+            doc = await self.hash_index.find_one({'_id': stored.sha256})
+            if doc['file_id'] == stored.file_id:
+                # Сбой после записи в индекс хэшей: это тот же самый файл
+                return stored
+            await self.fs.delete(ObjectId(stored.file_id))
+            self.stats['content_hits'] += 1
+            self.stats['bytes_saved'] += stored.size
+            return StoredFile(file_id=doc['file_id'], size=doc['size'], sha256=stored.sha256)
+
+    async def _remember_url(self, url: str, stored: StoredFile):
+        await self.url_index.update_one(
+            {'_id': url}, {'$set': {'file_id': stored.file_id, 'size': stored.size, 'sha256': stored.sha256}},
+            upsert=True
+        )
 
-    async def save_file(self, data: bytes, metadata: FileMetadata) -> str:
-        file_id = await self.fs.upload_from_stream(
+    async def _clear_abandoned(self, file_id: ObjectId):
+        """Удаляет куски оборванной загрузки. Свежие куски значат, что файл пишется прямо сейчас."""
+        # _id куска — ObjectId, в нём время вставки
+        stale = ObjectId.from_datetime(datetime.now(timezone.utc) - self.upload_timeout)
+        await self.chunks.delete_many({'files_id': file_id, '_id': {'$lt': stale}})
+        if await self.chunks.find_one({'files_id': file_id}, projection={'_id': 1}):
+            raise UploadInProgress(str(file_id))
+
+    async def save_stream(self, chunks: AsyncIterator[bytes], metadata: FileMetadata,
+                          max_size: Optional[int] = None) -> Optional[StoredFile]:
+        """Пишет файл в GridFS по мере поступления кусков, считая размер и sha256 на лету.
+        Если файл больше max_size, загрузка прерывается, уже записанные куски удаляются
+        и возвращается None. Файл с уже известным содержимым не хранится повторно."""
+        file_id = file_id_for_url(metadata.original_url)
+        await self._clear_abandoned(file_id)
+        grid_in = self.fs.open_upload_stream_with_id(
+            file_id,
             filename=metadata.filename or metadata.original_url.split('/')[-1],
-            source=io.BytesIO(data),
             metadata=metadata.model_dump()
         )
-        return str(file_id)
-
-    async def get_file(self, file_id: str):
+        digest = hashlib.sha256()
+        size = 0
+        # Время только на запись в GridFS, без ожидания кусков из сети
+        upload_time = 0.0
         try:
-            grid_out = await self.fs.open_download_stream(file_id)
-            return await grid_out.read()
-        except Exception:
-            return None
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    await grid_in.abort()
+                    return None
+                digest.update(chunk)
+                started = time.perf_counter()
+                await grid_in.write(chunk)
+                upload_time += time.perf_counter() - started
+            started = time.perf_counter()
+            metadata = metadata.model_copy(update={'size': size, 'sha256': digest.hexdigest()})
+            await grid_in.set('metadata', metadata.model_dump())
+            await grid_in.close()
+        except DuplicateKeyError as e:
+            # Тот же URL одновременно пишет другой процесс; его куски не трогаем
+            raise UploadInProgress(metadata.original_url) from e
+        except BaseException:
+            await grid_in.abort()
+            raise
+        stored = await self._deduplicate(StoredFile(file_id=str(grid_in._id), size=size, sha256=metadata.sha256))
+        await self._remember_url(metadata.original_url, stored)
+        metrics.record('gridfs_upload', upload_time + time.perf_counter() - started, metadata.original_url)
+        return stored
+
+    async def file_hashes(self, file_ids: Iterable[str]) -> Dict[str, str]:
+        """file_id → sha256 из метаданных; у файлов, загруженных до подсчёта хэшей, его нет."""
+        cursor = self.files.find({'_id': {'$in': [ObjectId(file_id) for file_id in file_ids]}},
+                                 projection={'metadata.sha256': 1})
+        return {str(doc['_id']): doc['metadata']['sha256'] async for doc in cursor
+                if (doc.get('metadata') or {}).get('sha256')}
+
+    async def download(self, file_id: str, destination: BinaryIO) -> str:
+        """Пишет файл в destination кусками GridFS и возвращает sha256 содержимого."""
+        grid_out = await self.fs.open_download_stream(ObjectId(file_id))
+        digest = hashlib.sha256()
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+            destination.write(chunk)
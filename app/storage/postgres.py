@@ -1,62 +1,432 @@
 # app/storage/postgres.py
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
-from app.models.postgres import Code, Name, Rawdata, Image
-from typing import List
+import asyncio
+from datetime import timedelta
+from loguru import logger
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select, update, func, text, or_
+from app.metrics import metrics
+from app.models.postgres import Checkpoint, Code, Name, Rawdata, Image
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Tuple
+
+
+# Статусы неудачной обработки: каждый увеличивает счётчик attempts
+FAILED_STATUSES = ('retry', 'error')
+# Строки, которые берутся в работу с начала: страницу нужно получить
+PENDING_STATUSES = ('pending', 'retry')
+# Имена продолжают с того шага, на котором остановились: parsed — осталось скачать файлы
+RESUMABLE_STATUSES = PENDING_STATUSES + ('parsed',)
+# Промежуточные статусы: строка остаётся арендованной тем же воркером
+IN_PROGRESS_STATUSES = ('parsed',)
+CLAIMABLE = {Code: PENDING_STATUSES, Name: RESUMABLE_STATUSES}
+
+
+def _utcnow():
+    # Время берётся у сервера БД, чтобы аренды не зависели от часов разных узлов.
+    # Колонки DateTime без часового пояса хранят UTC, как и created_at.
+    return func.timezone('UTC', func.now())
+
+
+def _releases_lease(status: str, failed: bool) -> bool:
+    # Промежуточный статус оставляет строку за воркером, остальные и любая неудача снимают аренду
+    return failed or status not in IN_PROGRESS_STATUSES
+
+
+def _chunks(rows: list, size: int):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
 
 
 class PostgresStorage:
-    def __init__(self, session: AsyncSession):
-        self.session = session
-
-    async def save_code(self, code: str, url: str):
-        stmt = select(Code).where(Code.code == code)
-        result = await self.session.execute(stmt)
-        existing = result.scalar_one_or_none()
-        if not existing:
-            new_code = Code(code=code, url=url)
-            self.session.add(new_code)
-            await self.session.commit()
-
-    async def get_pending_codes(self) -> List[Code]:
-        stmt = select(Code).where(Code.status == 'pending')
-        result = await self.session.execute(stmt)
-        return result.scalars().all()
-
-    async def update_code_status(self, code_id: int, status: str):
-        stmt = update(Code).where(Code.id == code_id).values(status=status)
-        await self.session.execute(stmt)
-        await self.session.commit()
-
-    async def save_name(self, product_code: str, name: str, url: str):
-        stmt = select(Name).where(Name.name == name)
-        result = await self.session.execute(stmt)
-        existing = result.scalar_one_or_none()
-        if not existing:
-            new_name = Name(product_code=product_code, name=name, url=url)
-            self.session.add(new_name)
-            await self.session.commit()
-
-    async def get_pending_names(self) -> List[Name]:
-        stmt = select(Name).where(Name.status == 'pending')
-        result = await self.session.execute(stmt)
-        return result.scalars().all()
-
-    async def update_name_status(self, name_id: int, status: str):
-        stmt = update(Name).where(Name.id == name_id).values(status=status)
-        await self.session.execute(stmt)
-        await self.session.commit()
-
-    async def save_rawdata(self, product_name: str, body_html: str):
-        stmt = select(Rawdata).where(Rawdata.product_name == product_name)
-        result = await self.session.execute(stmt)
-        existing = result.scalar_one_or_none()
-        if not existing:
-            new_rawdata = Rawdata(product_name=product_name, body_html=body_html)
-            self.session.add(new_rawdata)
-            await self.session.commit()
+    """Запись в Postgres пачками.
+
+    Коды и имена вставляются сразу (INSERT ... ON CONFLICT DO NOTHING), потому что
+    пайплайну нужны их id. Rawdata, images и смена статусов копятся в памяти и
+    сбрасываются одной транзакцией при `batch_size` строках или раз в `flush_interval`:
+    статус parsed фиксируется вместе со своими rawdata и images, stored — с file_id.
+
+    Каждая операция берёт из пула свою короткую сессию, поэтому воркеры пишут параллельно.
+
+    Таблицы codes/names работают как очередь задач для нескольких процессов: строки берутся
+    пачками через SELECT ... FOR UPDATE SKIP LOCKED и арендуются на `lease_seconds`
+    (locked_by/locked_until). Аренда снимается при смене статуса, а брошенная упавшим
+    процессом истекает сама. Статус меняет только текущий арендатор строки (compare-and-set
+    по locked_by), поэтому после перехвата аренды старый воркер ничего не перезапишет.
+
+    Строки берутся с запасом и могут ждать в очередях дольше аренды, поэтому каждую треть
+    `lease_seconds` аренда всех удерживаемых воркером строк продлевается.
+
+    Каждый SQL-оператор — отдельный метод, принимающий сессию (_insert_rawdata, _lease_rows, ...);
+    пачки, транзакции и учёт аренд собраны вокруг них. Хранилище в памяти для бенчмарка
+    (app/bench/storage.py) подменяет только эти методы.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, batch_size: int = 500, flush_interval: float = 1.0,
+                 worker_id: str = 'worker', lease_seconds: int = 600, retry_delay: int = 900):
+        self.session_factory = session_factory
+        self.worker_id = worker_id
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry_delay = timedelta(seconds=retry_delay)
+        # Сбросы идут строго по очереди, чтобы более старый статус не перезаписал новый
+        self.flush_lock = asyncio.Lock()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rawdata = {}
+        self._images = {}
+        self._statuses = {}
+        self._callbacks = []
+        self._held = {Code: set(), Name: set()}  # id арендованных строк, которые ещё не обработаны
+        self._flusher = None
+        self._renewer = None
+
+    async def __aenter__(self):
+        if self.flush_interval > 0:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        self._renewer = asyncio.create_task(self._renew_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for task in (self._flusher, self._renewer):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+        await self.release_leases()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # shield: отмена при закрытии не должна прервать уже начатую транзакцию
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                # Строки вернулись в буферы и уйдут со следующей пачкой
+                logger.error(f"Postgres flush failed, will retry: {e}")
+
+    async def _renew_periodically(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                await self.renew_leases()
+            except Exception as e:
+                # Следующая попытка — через треть аренды, до её истечения успеет ещё одна
+                logger.error(f"Lease renewal failed: {e}")
+
+    @property
+    def pending_rows(self) -> int:
+        return len(self._rawdata) + len(self._images) + len(self._statuses) + len(self._callbacks)
+
+    async def _maybe_flush(self):
+        if self.pending_rows >= self.batch_size:
+            await self.flush()
+
+    def after_flush(self, callback: Callable[[], None]):
+        """callback вызывается после коммита пачки, в которую попадёт всё, что уже накоплено."""
+        self._callbacks.append(callback)
+
+    async def flush(self):
+        # Через lock идём даже без данных: колбэки должны дождаться пачки, начатой раньше.
+        # Буферы забираются под lock, чтобы возвращённые после сбоя строки ушли раньше более новых
+        async with self.flush_lock:
+            rawdata, self._rawdata = self._rawdata, {}
+            images, self._images = self._images, {}
+            statuses, self._statuses = self._statuses, {}
+            callbacks, self._callbacks = self._callbacks, []
+            if rawdata or images or statuses:
+                try:
+                    await self._write(rawdata, images, statuses)
+                except BaseException:
+                    self._restore(rawdata, images, statuses, callbacks)
+                    raise
+        for callback in callbacks:
+            callback()
+
+    def _restore(self, rawdata: dict, images: dict, statuses: dict, callbacks: list):
+        """Возвращает в буферы пачку, которую не удалось записать; накопленное позже важнее."""
+        self._rawdata = {**self._rawdata, **rawdata}  # как в save_rawdata: первое тело остаётся
+        for key, row in self._images.items():
+            # Строка «файл ещё не скачан» не затирает file_id из неудавшейся пачки
+            if row['file_id'] is not None or key not in images:
+                images[key] = row
+        self._images = images
+        self._statuses = {**statuses, **self._statuses}
+        self._callbacks = callbacks + self._callbacks
+
+    async def _write(self, rawdata: dict, images: dict, statuses: dict):
+        with metrics.span('pg_write'):
+            await self._write_batch(rawdata, images, statuses)
+        for (model, row_id), (status, failed) in statuses.items():
+            if _releases_lease(status, failed):
+                self._held[model].discard(row_id)
+        metrics.inc('rows_written', len(rawdata), table='rawdata')
+        metrics.inc('rows_written', len(images), table='images')
+        metrics.inc('rows_written', len(statuses), table='statuses')
+
+    async def _write_batch(self, rawdata: dict, images: dict, statuses: dict):
+        async with self.session_factory() as session, session.begin():
+            for rows in _chunks(list(rawdata.values()), self.batch_size):
+                await self._insert_rawdata(session, rows)
+            for rows in _chunks(list(images.values()), self.batch_size):
+                await self._upsert_images(session, rows)
+            grouped = {}
+            for (model, row_id), (status, failed) in statuses.items():
+                grouped.setdefault((model, status, failed), []).append(row_id)
+            for (model, status, failed), ids in grouped.items():
+                release = _releases_lease(status, failed)
+                # Не раньше чем через retry_delay — иначе строку тут же возьмёт этот же прогон
+                retry_after = self.retry_delay if failed and status in RESUMABLE_STATUSES else None
+                await self._set_status(session, model, ids, status, failed, release, retry_after)
+
+    async def _insert_rawdata(self, session, rows: List[dict]):
+        stmt = insert(Rawdata).values(rows).on_conflict_do_nothing(index_elements=[Rawdata.product_name])
+        await session.execute(stmt)
+
+    async def _upsert_images(self, session, rows: List[dict]):
+        stmt = insert(Image).values(rows)
+        # Строка «файл ещё не скачан» (file_id NULL) не затирает уже сохранённый файл
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Image.product_name, Image.file_url],
+            set_={'file_id': func.coalesce(stmt.excluded.file_id, Image.file_id)}
+        )
+        await session.execute(stmt)
+
+    async def _set_status(self, session, model, ids: List[int], status: str, failed: bool, release: bool,
+                          retry_after: Optional[timedelta]):
+        """Статус строк ids, которые всё ещё арендует этот воркер. failed — attempts + 1;
+        release — снять аренду, а retry_after — не отдавать строку раньше этого срока."""
+        values = {'status': status}
+        if failed:
+            values['attempts'] = model.attempts + 1
+        if release:
+            values['locked_by'] = None
+            values['locked_until'] = _utcnow() + retry_after if retry_after else None
+        await session.execute(
+            update(model).where(model.id.in_(ids), model.locked_by == self.worker_id).values(**values)
+        )
+
+    async def save_codes_bulk(self, codes: Iterable[Tuple[str, str]], checkpoint: Optional[str] = None) -> int:
+        """Возвращает количество новых кодов. checkpoint — отметка, которая ставится в той же транзакции."""
+        rows = [{'code': code, 'url': url} for code, url in codes]
+        inserted = 0
+        with metrics.span('pg_write'):
+            async with self.session_factory() as session, session.begin():
+                for chunk in _chunks(rows, self.batch_size):
+                    inserted += await self._insert_codes(session, chunk)
+                if checkpoint:
+                    await self._set_checkpoint(session, checkpoint, f"{len(rows)} codes")
+        return inserted
+
+    async def _insert_codes(self, session, rows: List[dict]) -> int:
+        result = await session.execute(insert(Code).values(rows).on_conflict_do_nothing().returning(Code.id))
+        return len(result.all())
+
+    async def _set_checkpoint(self, session, key: str, value: str):
+        stmt = insert(Checkpoint).values(key=key, value=value, updated_at=_utcnow())
+        stmt = stmt.on_conflict_do_update(index_elements=[Checkpoint.key],
+                                          set_={'value': stmt.excluded.value, 'updated_at': stmt.excluded.updated_at})
+        await session.execute(stmt)
+
+    async def checkpoint_age(self, key: str) -> Optional[float]:
+        """Секунд с момента отметки key или None, если её ещё не ставили."""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(func.extract('epoch', _utcnow() - Checkpoint.updated_at)).where(Checkpoint.key == key)
+            )
+            age = result.scalar()
+            return float(age) if age is not None else None
+
+    async def has_pending_codes(self) -> bool:
+        """Остались ли в очереди коды, которые ещё нужно получить."""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(select(Code.id).where(Code.status.in_(PENDING_STATUSES)).exists())
+            )
+            return bool(result.scalar())
+
+    async def _claim(self, model, limit: int) -> list:
+        with metrics.span('pg_claim'):
+            async with self.session_factory() as session, session.begin():
+                rows = await self._lease_rows(session, model, limit)
+        return sorted(rows, key=lambda row: row.id)
+
+    async def _lease_rows(self, session, model, limit: int) -> list:
+        now = _utcnow()
+        claimable = (
+            select(model.id)
+            .where(model.status.in_(CLAIMABLE[model]),
+                   or_(model.locked_until.is_(None), model.locked_until < now))
+            .order_by(model.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(model)
+            .where(model.id.in_(claimable.scalar_subquery()))
+            .values(locked_by=self.worker_id, locked_until=now + self.lease)
+            .returning(model)
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(stmt)
+        return list(result.scalars().all())
+
+    def _hold(self, model, rows: list):
+        self._held[model].update(row.id for row in rows)
+
+    async def _renew(self, model, ids: list) -> list:
+        """Продлевает аренду строк ids и возвращает те, что всё ещё за этим воркером."""
+        renewed = []
+        async with self.session_factory() as session, session.begin():
+            for chunk in _chunks(ids, self.batch_size):
+                renewed.extend(await self._extend_leases(session, model, chunk))
+        return renewed
+
+    async def _extend_leases(self, session, model, ids: List[int]) -> List[int]:
+        result = await session.execute(
+            update(model)
+            .where(model.id.in_(ids), model.locked_by == self.worker_id)
+            .values(locked_until=_utcnow() + self.lease)
+            .returning(model.id)
+            .execution_options(synchronize_session=False)
+        )
+        return list(result.scalars().all())
+
+    async def renew_leases(self):
+        """Продлевает аренду строк, которые воркер взял, но ещё не обработал."""
+        for model, held in self._held.items():
+            ids = sorted(held)
+            if not ids:
+                continue
+            with metrics.span('pg_renew'):
+                renewed = await self._renew(model, ids)
+            # Перехваченные строки больше не продлеваем: их результат всё равно не запишется
+            held.difference_update(set(ids) - set(renewed))
+
+    async def _iter_claims(self, model, batch_size: int) -> AsyncIterator:
+        while True:
+            batch = await self._claim(model, batch_size)
+            if not batch:
+                return
+            self._hold(model, batch)
+            for row in batch:
+                yield row
+
+    def iter_pending_codes(self, batch_size: int) -> AsyncIterator[Code]:
+        """Коды, арендованные этим воркером, пачками по batch_size, пока есть свободные."""
+        return self._iter_claims(Code, batch_size)
+
+    async def update_code_status(self, code_id: int, status: str, failed: Optional[bool] = None):
+        """failed — неудачная попытка (attempts + 1); по умолчанию определяется по статусу."""
+        self._statuses[(Code, code_id)] = (status, status in FAILED_STATUSES if failed is None else failed)
+        await self._maybe_flush()
+
+    async def _insert_names(self, session, names: Iterable[Tuple[str, str, str]]) -> List[Name]:
+        rows = [{'product_code': code, 'name': name, 'url': url} for code, name, url in names]
+        inserted = []
+        for chunk in _chunks(rows, self.batch_size):
+            inserted.extend(await self._insert_leased_names(session, chunk))
+        self._hold(Name, inserted)
+        return inserted
+
+    async def _insert_leased_names(self, session, rows: List[dict]) -> List[Name]:
+        """Новые имена сразу арендованы этим воркером; уже известные пропускаются."""
+        locked_until = _utcnow() + self.lease
+        rows = [{**row, 'locked_by': self.worker_id, 'locked_until': locked_until} for row in rows]
+        result = await session.execute(insert(Name).values(rows).on_conflict_do_nothing().returning(Name))
+        return list(result.scalars().all())
+
+    async def save_names_bulk(self, names: Iterable[Tuple[str, str, str]]) -> List[Name]:
+        """names — тройки (product_code, name, url). Возвращает только вставленные записи;
+        они сразу арендованы этим воркером, чтобы их не взял другой процесс."""
+        with metrics.span('pg_write'):
+            async with self.session_factory() as session, session.begin():
+                return await self._insert_names(session, names)
+
+    async def complete_code(self, code_id: int, names: Iterable[Tuple[str, str, str]]) -> Optional[List[Name]]:
+        """Одной транзакцией переводит код в fetched и вставляет найденные на его странице имена.
+        Возвращает новые имена; None — аренду кода перехватил другой воркер, ничего не изменено."""
+        with metrics.span('pg_write'):
+            async with self.session_factory() as session, session.begin():
+                finished = await self._finish_code(session, code_id)
+                self._held[Code].discard(code_id)
+                if not finished:
+                    return None
+                return await self._insert_names(session, names)
+
+    async def _finish_code(self, session, code_id: int) -> bool:
+        """fetched для кода, который всё ещё арендует этот воркер; False — аренду перехватили."""
+        result = await session.execute(
+            update(Code)
+            .where(Code.id == code_id, Code.locked_by == self.worker_id)
+            .values(status='fetched', locked_by=None, locked_until=None)
+            .returning(Code.id)
+        )
+        return result.first() is not None
+
+    def iter_pending_names(self, batch_size: int) -> AsyncIterator[Name]:
+        """Свободные имена: оставшиеся с прошлых запусков или брошенные упавшими воркерами."""
+        return self._iter_claims(Name, batch_size)
+
+    async def release_leases(self):
+        """Возвращает в очередь строки, которые этот воркер взял, но не успел обработать."""
+        for held in self._held.values():
+            held.clear()
+        async with self.session_factory() as session, session.begin():
+            for model in (Code, Name):
+                await self._release_rows(session, model)
+
+    async def _release_rows(self, session, model):
+        await session.execute(
+            update(model)
+            .where(model.locked_by == self.worker_id, model.status.in_(CLAIMABLE[model]))
+            .values(locked_by=None, locked_until=None)
+        )
+
+    async def update_name_status(self, name_id: int, status: str, failed: Optional[bool] = None):
+        """failed — неудачная попытка: parsed с failed=True вернёт имя в очередь докачивать файлы."""
+        self._statuses[(Name, name_id)] = (status, status in FAILED_STATUSES if failed is None else failed)
+        await self._maybe_flush()
+
+    async def save_rawdata(self, product_name: str, body_html: Optional[str] = None,
+                           body_zip: Optional[bytes] = None, body_codec: Optional[str] = None,
+                           body_sha256: Optional[str] = None):
+        """Либо body_html, либо сжатые body_zip и body_codec (см. app/storage/codec.py)."""
+        # У всех строк пачки одинаковый набор ключей — иначе не собрать один INSERT ... VALUES
+        self._rawdata.setdefault(product_name, {'product_name': product_name, 'body_html': body_html,
+                                                'body_zip': body_zip, 'body_codec': body_codec,
+                                                'body_sha256': body_sha256})
+        await self._maybe_flush()
 
     async def save_image(self, product_name: str, file_id: str, file_url: str):
-        new_image = Image(product_name=product_name, file_id=file_id, file_url=file_url)
-        self.session.add(new_image)
-        await self.session.commit()
+        self._images[(product_name, file_url)] = {'product_name': product_name, 'file_id': file_id,
+                                                  'file_url': file_url}
+        await self._maybe_flush()
+
+    async def save_pending_images(self, product_name: str, file_urls: Iterable[str]):
+        """Файлы, найденные на странице товара: строки images с file_id NULL до скачивания."""
+        for file_url in file_urls:
+            self._images.setdefault((product_name, file_url), {'product_name': product_name, 'file_id': None,
+                                                               'file_url': file_url})
+        await self._maybe_flush()
+
+    async def pending_files(self, product_name: str) -> List[str]:
+        """Ещё не скачанные файлы товара — для продолжения прерванной обработки."""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Image.file_url).where(Image.product_name == product_name, Image.file_id.is_(None))
+                .order_by(Image.id)
+            )
+            return list(result.scalars().all())
+
+    async def has_rawdata(self, product_name: str) -> bool:
+        """Сохранено ли уже тело страницы товара — независимо от того, что лежит в кэше HTTP."""
+        async with self.session_factory() as session:
+            result = await session.execute(select(Rawdata.id).where(Rawdata.product_name == product_name).limit(1))
+            return result.first() is not None
+
+    async def estimate_rawdata_count(self) -> int:
+        """Оценка числа строк rawdata из статистики планировщика — без сканирования таблицы."""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'rawdata'::regclass")
+            )
+            return max(result.scalar() or 0, 0)
@@ -0,0 +1,13 @@
+# app/utils.py
+from urllib.parse import urljoin
+
+
+def absolute_url(base_url: str, url: str) -> str:
+    """Ссылки от корня (/product/123/) дописываются к base_url, как и раньше: каталог реестра
+    живёт под путём base_url, и так построены все уже сохранённые URL. Остальные относительные
+    ссылки (?page=2, //host/...) разрешаются по правилам urljoin."""
+    if url.startswith('http'):
+        return url
+    if url.startswith('/') and not url.startswith('//'):
+        return base_url.rstrip('/') + url
+    return urljoin(base_url, url)